@@ -11,6 +11,7 @@ build(){
 
 build key-detect
 build rubber
+build spleeter
 build server
 
 docker pull thr3a/yt-dlp
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
+import argparse
+import glob
 import json
+import os
 import shutil
 import sys
 from datetime import datetime
+from multiprocessing import Pool as ProcessPool
 from os import remove
 
 import numpy as np
@@ -12,6 +16,7 @@ from essentia.standard import (
     HPCP,
     Key,
     MonoLoader,
+    Resample,
     SpectralPeaks,
     Spectrum,
     Windowing,
@@ -19,25 +24,96 @@ from essentia.standard import (
 
 FRAME_SIZE = 2048
 HOP_SIZE = 1024
-
-
-def detect_key(audio):
-    spec = Spectrum(size=FRAME_SIZE)
-    spec_peaks = SpectralPeaks()
-    hpcp = HPCP()
-    key = Key(profileType="edma")
-    w = Windowing(type="blackmanharris92")
-    pool = Pool()
-
-    for frame in FrameGenerator(audio, frameSize=FRAME_SIZE, hopSize=HOP_SIZE):
-        frame_spectrum = spec(w(frame))
-        frequencies, magnitudes = spec_peaks(frame_spectrum)
-        hpcpValue = hpcp(frequencies, magnitudes)
-        pool.add("hpcp", hpcpValue)
-
-    hpcp_avg = np.average(pool["hpcp"], axis=0)
-    detected_key, scale, _, _ = key(hpcp_avg)
-    return detected_key, scale
+SAMPLE_RATE = 44100
+AUDIO_EXTENSIONS = ['.wav', '.mp3', '.flac', '.ogg', '.m4a', '.aac']
+
+# progressive mode: segments spread over the song, at a quarter of the rate (the hpcp stops at 5kHz anyway),
+# until the estimate has held for STABLE_SEGMENTS segments at MIN_STRENGTH or better
+MODE = os.environ.get('KEYDETECT_MODE', 'full')
+MIN_STRENGTH = float(os.environ.get('KEYDETECT_MIN_STRENGTH', 0.6))
+DECIMATION = 4
+SEGMENT_SECONDS = 8
+MAX_SEGMENTS = 24
+STABLE_SEGMENTS = 3
+
+
+class Detector:
+    # the algorithm objects are built once and reused for every file a process handles
+    def __init__(self):
+        self.spec = Spectrum(size=FRAME_SIZE)
+        self.window = Windowing(type="blackmanharris92")
+        self.key = Key(profileType="edma")
+        self.peaks = {rate: SpectralPeaks(sampleRate=rate) for rate in [SAMPLE_RATE, SAMPLE_RATE // DECIMATION]}
+        self.hpcp = {rate: HPCP(sampleRate=rate) for rate in [SAMPLE_RATE, SAMPLE_RATE // DECIMATION]}
+        self.resample = Resample(inputSampleRate=SAMPLE_RATE, outputSampleRate=SAMPLE_RATE // DECIMATION)
+
+    def hpcps(self, audio, sample_rate=SAMPLE_RATE):
+        spec_peaks = self.peaks[sample_rate]
+        hpcp = self.hpcp[sample_rate]
+        pool = Pool()
+
+        for frame in FrameGenerator(audio, frameSize=FRAME_SIZE, hopSize=HOP_SIZE):
+            frame_spectrum = self.spec(self.window(frame))
+            frequencies, magnitudes = spec_peaks(frame_spectrum)
+            hpcpValue = hpcp(frequencies, magnitudes)
+            pool.add("hpcp", hpcpValue)
+
+        return pool["hpcp"] if "hpcp" in pool.descriptorNames() else np.zeros((0, 12))
+
+    def detect_key(self, audio):
+        hpcp_avg = np.average(self.hpcps(audio), axis=0)
+        return self.key(hpcp_avg)
+
+    def detect_key_progressive(self, audio):
+        segment = SEGMENT_SECONDS * SAMPLE_RATE
+        if len(audio) < segment * STABLE_SEGMENTS * 2:
+            return self.detect_key(audio)
+
+        total, frames, estimates = np.zeros(12), 0, []
+        for start in segment_starts(len(audio), segment):
+            pcps = self.hpcps(self.resample(audio[start:start + segment]), SAMPLE_RATE // DECIMATION)
+            total += pcps.sum(axis=0)
+            frames += len(pcps)
+            if not frames:
+                continue
+
+            estimate = self.key((total / frames).astype(np.float32))
+            estimates.append(estimate)
+            recent = estimates[-STABLE_SEGMENTS:]
+            if len(recent) == STABLE_SEGMENTS and len({e[:2] for e in recent}) == 1 and \
+                    all(e[2] >= MIN_STRENGTH for e in recent):
+                return estimate
+
+        # never settled, so it gets the whole song
+        return self.detect_key(audio)
+
+    def analyze(self, filename):
+        # Load the audio file, resampled to a 44.1kHz mono signal
+        audio = MonoLoader(filename=filename, sampleRate=SAMPLE_RATE)()
+
+        # Detect the key and scale
+        if MODE == 'progressive':
+            key, scale, strength, relative = self.detect_key_progressive(audio)
+        else:
+            key, scale, strength, relative = self.detect_key(audio)
+
+        return {
+            "key": key,
+            "scale": scale,
+            "strength": float(strength),
+            "relative_strength": float(relative),
+        }
+
+
+def segment_starts(length, segment):
+    # van der corput order: each new segment lands in the largest gap left, so early ones cover the whole song
+    for n in range(1, MAX_SEGMENTS + 1):
+        position, denominator = 0.0, 1
+        while n:
+            denominator *= 2
+            n, remainder = divmod(n, 2)
+            position += remainder / denominator
+        yield int(position * (length - segment))
 
 
 def handler(filename):
@@ -49,19 +125,11 @@ def handler(filename):
 
     shutil.copy2(filename, tmp_filename)
 
-    # Load the audio file, resampled to a 44.1kHz mono signal
-    loader = MonoLoader(filename=tmp_filename, sampleRate=44100)
-    audio = loader()
-
-    # Detect the key and scale
-    key, scale = detect_key(audio)
-
-    data = {
-        "key": key,
-        "scale": scale,
+    data = Detector().analyze(tmp_filename)
+    data.update({
         "filename": filename,
         "timestamp": datetime.utcnow().isoformat(),
-    }
+    })
 
     # delete the temporary file
     remove(tmp_filename)
@@ -69,8 +137,76 @@ def handler(filename):
     return json.dumps(data)
 
 
+# batch mode: one interpreter and one set of algorithm objects per worker, rather than per file
+
+_detector = None
+
+
+def init_worker():
+    global _detector
+    _detector = Detector()
+
+
+def analyze_one(filename):
+    # a bad file is reported in its own line rather than ending the run
+    data = {"filename": filename}
+    try:
+        data.update(_detector.analyze(filename))
+    except Exception as e:
+        data["error"] = f"{e.__class__.__name__}: {e}"
+
+    data["timestamp"] = datetime.utcnow().isoformat()
+    return data
+
+
+def list_inputs(source):
+    # a directory (searched recursively), a manifest of one path per line, or a glob
+    if os.path.isdir(source):
+        found = []
+        for root, _, files in os.walk(source):
+            found += [os.path.join(root, f) for f in files if os.path.splitext(f)[1].lower() in AUDIO_EXTENSIONS]
+        return sorted(found)
+
+    if os.path.isfile(source) and os.path.splitext(source)[1].lower() not in AUDIO_EXTENSIONS:
+        with open(source) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    return sorted(glob.glob(source, recursive=True))
+
+
+def batch(argv):
+    parser = argparse.ArgumentParser(prog='key-detect --batch')
+    parser.add_argument('source', help='a directory, a glob, or a file listing one path per line')
+    parser.add_argument('outfile', help='json lines, one per input, in completion order; - for stdout')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    inputs = list_inputs(args.source)
+    if not inputs:
+        print(f"no inputs in {args.source}", file=sys.stderr)
+        return 1
+
+    failed = 0
+    out = sys.stdout if args.outfile == '-' else open(args.outfile, 'w')
+    try:
+        with ProcessPool(min(args.workers, len(inputs)), initializer=init_worker) as pool:
+            for data in pool.imap_unordered(analyze_one, inputs):
+                failed += "error" in data
+                out.write(json.dumps(data) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"{len(inputs)} files, {failed} failed", file=sys.stderr)
+    return 0
+
+
 if __name__ == '__main__':
     args = [a for a in sys.argv]
+    if len(args) > 1 and args[1] == '--batch':
+        sys.exit(batch(args[2:]))
+
     outfile = args.pop()
     infile = args.pop()
     with open(outfile, 'w') as f:
@@ -1,17 +1,32 @@
 #!/usr/bin/env python
+from server.consts import WEB_SERVER
+
+if WEB_SERVER == 'gevent':
+    # cooperative sockets, so an idle event stream costs a greenlet rather than a thread
+    from gevent import monkey
+
+    monkey.patch_all()
+
 import os
 import re
 from datetime import datetime
 
 import flask_login
 import validators
-from flask import Flask, request, render_template, url_for, redirect, abort
+from flask import Flask, request, render_template, url_for, redirect, abort, Response, make_response, \
+    stream_with_context
 from flask_cors import CORS
 from redis import StrictRedis
 
-from db import db, User, TrackFlags, Track, TrackStatus, files_data_for, COMMON_KEYS
+from server.consts import POLL_CACHE_SECONDS, SSE_KEEPALIVE_SECONDS
+from server.db import db, User, TrackFlags, Track, TrackStatus, files_data_for, track_version, request_render, \
+    COMMON_KEYS, KEY_OFFSETS
+from server.cache import follow
+from server.errs import JobError
+from server.events import Broker
 from server.log import logger
-from server.util import serial
+from server.metrics import render_metrics
+from server.util import serial, video_id, make_key, offset_key, signed
 
 env = os.environ.get
 app = Flask(__name__)
@@ -24,8 +39,10 @@ app.config['UPLOAD_EXTENSIONS'] = ['.mp3', '.wav']
 app.config['UPLOAD_PATH'] = env('UPLOAD_DIR', '/tmp/uploads')
 app.config['OUTPUT_DIR'] = env('OUTPUT_DIR', '/tmp/spleets')
 app.config['REDIS_HOST'] = env('REDIS_HOST', 'localhost')
+app.config['PAGE_SIZE'] = int(env('PAGE_SIZE', 20))
 
 red = StrictRedis(host=app.config['REDIS_HOST'])
+broker = Broker(red)
 
 
 def get_or_create_user(username, by_id=False):
@@ -90,7 +107,13 @@ def logout():
 
 @app.before_request
 def setup():
-    db.connect()
+    db.connect(reuse_if_open=True)
+
+
+@app.teardown_request
+def teardown(exc):
+    if not db.is_closed():
+        db.close()
 
 
 def from_form(key):
@@ -114,6 +137,7 @@ def add_job():
         (is_checked('is_private'), TrackFlags.PRIVATE),
         (is_checked('rekey_common'), TrackFlags.REKEY_COMMON),
         (is_checked('prioritize_split'), TrackFlags.NOVOX_FIRST),
+        (is_checked('rekey_lazy'), TrackFlags.REKEY_LAZY),
     ]
 
     for add, flag in raised:
@@ -129,16 +153,35 @@ def add_job():
     if not url:
         return redirect(url_for('index', error="That doesn't look like a url to me."))
 
+    offsets = parse_offsets(from_form('offsets'))
+    if offsets is None:
+        return redirect(url_for('index', error="Keys are semitone offsets from -6 to +6, like: -2, +3"))
+
     try:
-        return create_job(url, flags)
+        return create_job(url, flags, offsets)
     except Exception as e:
         return redirect(url_for('index', error=str(e)))
 
 
+def parse_offsets(text):
+    try:
+        offsets = sorted({int(k) for k in re.split('[,\\s]+', text or '') if k})
+    except ValueError:
+        return None
+
+    if any(k not in KEY_OFFSETS for k in offsets):
+        return None
+    return offsets
+
+
 def valid_url(url):
     try:
         if not validators.url(url):
             return None
+
+        vid = video_id(url)
+        if vid:
+            return f'https://www.youtube.com/watch?v={vid}'
         return re.sub('[=&]pp=[a-zA-Z0-9%]+', '', url)
     except:
         logger.warn(f"Invalid URL: {url}")
@@ -148,43 +191,205 @@ def valid_url(url):
 @flask_login.login_required
 @app.route('/tracks', methods=['GET'])
 def job_list():
-    try:
-        tracks = Track.select().order_by(Track.updated.desc())
-        tracks = filter_private(tracks)
-        tracks = serial(list(tracks), raw=True)
-    except Track.DoesNotExist:
-        tracks = []
+    before = parse_cursor(request.args.get('before'))
+    tracks = list(visible_tracks(before))
+
+    cursor = None
+    if len(tracks) > app.config['PAGE_SIZE']:
+        tracks = tracks[:app.config['PAGE_SIZE']]
+        cursor = make_cursor(tracks[-1])
+
+    context = dict(tracks=serial(tracks, raw=True), cursor=cursor, now=datetime.now())
+    if not before:
+        return render_template('songs.j2', **context)
+
+    # once older pages are scrolled in, a poll of the first page would wipe them
+    response = make_response(render_template('songs_page.j2', **context))
+    response.headers['HX-Trigger'] = 'stopPolling'
+    return response
+
 
-    return render_template('songs.j2', tracks=tracks, now=datetime.now())
+def visible_tracks(before=None):
+    # public tracks plus the current user's own, newest first, one page (plus one to detect more)
+    me = getattr(flask_login.current_user, 'id', None)
+    query = (Track
+             .select(Track, User)
+             .join(User)
+             .where((Track.flags.bin_and(TrackFlags.PRIVATE.value) == 0) | (Track.user == me)))
 
+    # ids never change, so a track can't move between pages the way it would when ordered by updated
+    if before:
+        query = query.where(Track.id < before)
 
-def filter_private(tracks):
-    keep = []
-    for t in tracks:
-        me = t.user == flask_login.current_user
-        public = not t.has_flag(TrackFlags.PRIVATE)
-        if me or public:
-            keep.append(t)
+    return query.order_by(Track.id.desc()).limit(app.config['PAGE_SIZE'] + 1)
 
-    return keep
+
+def make_cursor(track):
+    return str(track.id)
+
+
+def parse_cursor(cursor):
+    try:
+        return int(cursor)
+    except (TypeError, ValueError):
+        return None
 
 
 @app.route('/track/<uuid:uuid>', methods=['GET'])
 def view_track(uuid):
-    return render_track(uuid, 'track.j2')
+    track = Track.get_or_none(Track.uuid == uuid)
+    if not track:
+        abort(404)
+
+    return render_track(track, 'track.j2')
+
+
+@app.route('/track/<uuid:uuid>/render', methods=['POST'])
+@flask_login.login_required
+def render_key(uuid):
+    track = Track.get_or_none(Track.uuid == uuid)
+    # same rule as visible_tracks: someone else's private track isn't there as far as this user is concerned
+    if not track or (track.has_flag(TrackFlags.PRIVATE) and track.user_id != flask_login.current_user.id):
+        abort(404)
+
+    try:
+        offset = int(from_form('offset'))
+    except (TypeError, ValueError):
+        abort(400)
+
+    if offset not in KEY_OFFSETS or not track.has_flag(TrackFlags.REKEY_LAZY):
+        abort(400)
+
+    # None means the track is busy with something else, usually cleaning up after its last render
+    try:
+        files = request_render(track, offset, red)
+    except JobError as e:
+        abort(410, description=str(e))
+    if files is None:
+        abort(409)
+
+    return redirect(url_for('view_track', uuid=track.uuid))
 
 
 @app.route('/poll/<uuid:uuid>', methods=['GET'])
 def poll_track(uuid):
-    return render_track(uuid, 'track_inner.j2')
+    track = Track.get_or_none(Track.uuid == uuid)
+    if not track:
+        abort(404)
 
+    etag = track_etag(track)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(track_fragment(track, etag))
 
-def render_track(uuid, tpl):
-    try:
-        track = Track.get(Track.uuid == uuid)
-    except Track.DoesNotExist as e:
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    if is_finished(track):
+        response.headers['HX-Trigger'] = 'stopPolling'
+    return response
+
+
+@app.route('/events/<uuid:uuid>', methods=['GET'])
+def track_events(uuid):
+    track = Track.get_or_none(Track.uuid == uuid)
+    if not track:
         abort(404)
 
+    # 204 tells the browser's EventSource not to reconnect
+    if is_finished(track):
+        return Response(status=204)
+
+    def stream(track_id):
+        with broker.listening(track_id) as mailbox:
+            while True:
+                if not mailbox.take(SSE_KEEPALIVE_SECONDS):
+                    yield ': keepalive\n\n'
+                    continue
+
+                with db.connection_context():
+                    track = Track.get_by_id(track_id)
+                    fragment = track_fragment(track, track_etag(track))
+
+                yield sse('trackUpdate', fragment)
+                if is_finished(track):
+                    return
+
+    return event_stream(stream(track.id))
+
+
+@app.route('/events/tracks', methods=['GET'])
+def list_events():
+    me = getattr(flask_login.current_user, 'id', None)
+
+    def stream():
+        with broker.listening() as mailbox:
+            # the current state first, so a reconnect catches up on what changed while it was away
+            with db.connection_context():
+                tracks = list(visible_tracks())[:app.config['PAGE_SIZE']]
+                newest = max((t.id for t in tracks), default=0)
+                cards = render_template('track_cards.j2', tracks=serial(tracks, raw=True), now=datetime.now())
+            yield sse('trackCards', cards)
+
+            while True:
+                changed = mailbox.take(SSE_KEEPALIVE_SECONDS)
+                if not changed:
+                    yield ': keepalive\n\n'
+                    continue
+
+                with db.connection_context():
+                    tracks = Track.select().where(Track.id.in_(list(changed)))
+                    tracks = [t for t in tracks if t.user_id == me or not t.has_flag(TrackFlags.PRIVATE)]
+                    if not tracks:
+                        continue
+
+                    # out of band swaps, so only cards already on the page change
+                    cards = render_template('track_cards.j2', tracks=serial(tracks, raw=True), now=datetime.now())
+
+                # a song added since the stream opened has no card to swap, the list reloads to show it
+                added = [t.id for t in tracks if t.id > newest]
+                if added:
+                    newest = max(added)
+                    yield sse('songsAdded', ' '.join(map(str, added)))
+
+                yield sse('trackCards', cards)
+
+    return event_stream(stream())
+
+
+def event_stream(events):
+    # idle clients only hold a mailbox; the request's db connection is released up front
+    db.close()
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers=headers)
+
+
+def sse(event, data):
+    lines = ''.join(f'data: {line}\n' for line in data.strip().splitlines())
+    return f'event: {event}\n{lines}\n'
+
+
+def track_etag(track):
+    return f'{track.id}.{track_version(track)}'
+
+
+def track_fragment(track, etag):
+    # the fragment only changes with a status change, so it's cached per version
+    key = make_key('poll', etag)
+    fragment = red.get(key)
+    if fragment is None:
+        fragment = render_track(track, 'track_inner.j2')
+        red.set(key, fragment, ex=POLL_CACHE_SECONDS)
+        return fragment
+
+    return fragment.decode('utf-8')
+
+
+def is_finished(track):
+    return track.is_status([TrackStatus.DONE, TrackStatus.ERROR])
+
+
+def render_track(track, tpl):
     now = datetime.now()
     context = dict(
         track=track.serial(),
@@ -192,25 +397,48 @@ def render_track(uuid, tpl):
         now=serial(now),
         updated_delta=serial(track.updated - track.created),
         now_delta=serial(now - track.created),
-        is_done=track.is_status([TrackStatus.DONE, TrackStatus.ERROR]),
+        # created is naive server-local time, the browser needs the instant to count from
+        created_ms=int(track.created.timestamp() * 1000),
+        is_done=is_finished(track),
+        lazy_keys=lazy_keys(track),
     )
 
     return render_template(tpl, **context)
 
 
-def create_job(url, flags):
+def lazy_keys(track):
+    if not track.is_status([TrackStatus.DONE, TrackStatus.NEEDS_REKEY, TrackStatus.REKEYING]):
+        return []
+
+    return [dict(offset=k, key_offset=signed(k), key=f'{offset_key(track.key, k)} {track.quality}')
+            for k in track.lazy_offsets()]
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(red), mimetype='text/plain; version=0.0.4')
+
+
+def create_job(url, flags, offsets=None):
     track = Track(
         url=url,
         flags=flags,
+        offsets=','.join(map(str, offsets)) if offsets else None,
         user=flask_login.current_user,
         status=TrackStatus.QUEUED
     )
 
     track.save()
-    track.next_status(red)
+    if not follow(track, red):
+        track.next_status(red)
 
     return redirect(url_for('view_track', uuid=track.uuid))
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=1337)
+    if WEB_SERVER == 'gevent':
+        from gevent.pywsgi import WSGIServer
+
+        WSGIServer(('0.0.0.0', 1337), app).serve_forever()
+    else:
+        app.run(host='0.0.0.0', port=1337, threaded=True)
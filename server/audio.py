@@ -0,0 +1,121 @@
+import os
+import struct
+import wave
+
+import numpy as np
+
+from server.errs import JobError
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+DTYPES = {
+    (WAVE_FORMAT_PCM, 16): '<i2',
+    (WAVE_FORMAT_PCM, 32): '<i4',
+    (WAVE_FORMAT_FLOAT, 32): '<f4',
+    (WAVE_FORMAT_FLOAT, 64): '<f8',
+}
+
+# a pcm file is float32 frames, interleaved, after a fixed size header. readers map it as is
+PCM_MAGIC = b'REKEYPCM'
+PCM_HEADER = struct.Struct('<8sIIQ')
+PCM_DATA_OFFSET = 64
+PCM_CHUNK_FRAMES = 1 << 18
+
+
+def read_audio(wav):
+    # the wav's pcm if it has one, else the wav itself
+    path = pcm_path(wav)
+    if os.path.isfile(path):
+        return read_pcm(path)
+    return read_wav(wav)
+
+
+def pcm_path(wav):
+    return os.path.splitext(wav)[0] + '.pcm'
+
+
+def write_pcm(wav):
+    # decoded once per source, in chunks; the rename means readers never see a partial file
+    samples, rate = read_wav(wav)
+    path = pcm_path(wav)
+    partial = f'{path}.partial'
+    with open(partial, 'wb') as f:
+        f.write(PCM_HEADER.pack(PCM_MAGIC, rate, samples.shape[1], len(samples)).ljust(PCM_DATA_OFFSET, b'\0'))
+        for start in range(0, len(samples), PCM_CHUNK_FRAMES):
+            f.write(np.ascontiguousarray(to_float(samples[start:start + PCM_CHUNK_FRAMES]), dtype='<f4').tobytes())
+
+    os.replace(partial, path)
+    return path
+
+
+def read_pcm(path):
+    with open(path, 'rb') as f:
+        magic, rate, channels, frames = PCM_HEADER.unpack(f.read(PCM_HEADER.size))
+
+    if magic != PCM_MAGIC:
+        raise JobError(f'not a pcm file: {path}')
+
+    samples = np.memmap(path, dtype='<f4', mode='r', offset=PCM_DATA_OFFSET, shape=(frames, channels))
+    return samples, rate
+
+
+def read_wav(path):
+    # memory-maps the data chunk, returns ((frames, channels) array, sample rate)
+    fmt = None
+    with open(path, 'rb') as f:
+        riff = f.read(12)
+        if riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise JobError(f'not a wav file: {path}')
+
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise JobError(f'no data chunk: {path}')
+
+            chunk, size = struct.unpack('<4sI', header)
+            if chunk == b'fmt ':
+                fmt = f.read(size + (size & 1))
+            elif chunk == b'data':
+                offset = f.tell()
+                break
+            else:
+                f.seek(size + (size & 1), 1)
+
+        f.seek(0, 2)
+        available = f.tell() - offset
+
+    if not fmt:
+        raise JobError(f'no fmt chunk: {path}')
+
+    tag, channels, rate, _, _, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if tag == WAVE_FORMAT_EXTENSIBLE:
+        tag = struct.unpack('<H', fmt[24:26])[0]
+
+    dtype = DTYPES.get((tag, bits))
+    if not dtype:
+        raise JobError(f'unsupported wav encoding {tag}/{bits}bit: {path}')
+
+    # streamed wavs may carry a bogus data size, so trust the file length
+    frames = min(size, available) // (channels * bits // 8)
+    samples = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(frames, channels))
+    return samples, rate
+
+
+def to_float(samples):
+    if samples.dtype.kind == 'f':
+        return np.asarray(samples, dtype=np.float32)
+
+    scale = float(np.iinfo(samples.dtype).max) + 1
+    return np.asarray(samples, dtype=np.float32) / scale
+
+
+def write_wav(path, samples, rate):
+    pcm = np.clip(samples, -1, 1) * 32767
+    pcm = np.ascontiguousarray(pcm, dtype='<i2')
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(pcm.shape[1])
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm.tobytes())
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+import argparse
+import functools
+import json
+import logging
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import numpy as np
+
+# usage: bench.py --tracks 50 --concurrency 2 --concurrency rekey=8 --delay rubberband=0.5
+# runs every stage's real Task class in-process against a temp sqlite db, fakeredis (or --redis-host),
+# a fake docker client that writes deterministic outputs, and a filesystem-backed fake s3.
+
+STAGES = [
+    # (label, model, waiting status, working status)
+    ('meta', 'Track', 'NEEDS_METADATA', 'GETTING_METADATA'),
+    ('download', 'Track', 'NEEDS_DOWNLOAD', 'DOWNLOADING'),
+    ('key_detect', 'Track', 'NEEDS_KEYDETECT', 'GETTING_KEY'),
+    ('spleet', 'Track', 'NEEDS_SPLIT', 'SPLITTING'),
+    ('rekey', 'TrackFile', 'QUEUED', 'WORKING'),
+    ('encode', 'TrackFile', 'NEEDS_ENCODING', 'ENCODING'),
+    ('upload', 'TrackFile', 'NEEDS_UPLOAD', 'UPLOADING'),
+    ('cleanup', 'Track', 'NEEDS_CLEANUP', 'CLEANING_UP'),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tracks', type=int, default=10)
+    parser.add_argument('--seconds', type=float, default=2.0, help='length of the fake downloaded audio')
+    parser.add_argument('--concurrency', action='append', default=[],
+                        help='N for every queue, or queue=N (e.g. rekey=8)')
+    parser.add_argument('--delay', action='append', default=[],
+                        help='image=seconds of simulated work per container run (ytdlp, keydetect, spleeter, '
+                             'rubberband, ffmpeg, s3)')
+    parser.add_argument('--flags', type=int, default=0, help='TrackFlags bits for every submitted track')
+    parser.add_argument('--redis-host', help='use a real redis instead of fakeredis')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--verbose', action='store_true', help='keep the workers\' info logging')
+    return parser.parse_args()
+
+
+def configure(args, scratch):
+    # consts are read at import time, so all of this happens before importing server modules
+    dirs = dict(ytdlp='YTDLP_OUTPUT_DIR', spleets='SPLEETER_OUTPUT_DIR', keydetect='KEYDETECT_OUTPUT_DIR',
+                rubberband='RUBBERBAND_OUTPUT_DIR', s3='BENCH_S3_DIR')
+    for name, var in dirs.items():
+        path = os.path.join(scratch, name)
+        os.makedirs(path)
+        os.environ[var] = path
+
+    os.environ['DATABASE_FILE'] = os.path.join(scratch, 'bench.db')
+    os.environ['QUEUE_BLOCK_TIMEOUT'] = '1'
+    os.environ['RESULT_CACHE'] = '0'
+
+    queues = ['meta', 'download', 'key_detect', 'spleet', 'rekey', 'rekey_batch', 'encode', 'upload', 'cleanup']
+    for value in args.concurrency:
+        name, _, count = value.rpartition('=')
+        for queue in [name] if name else queues:
+            os.environ[f'{queue.upper()}_CONCURRENCY'] = count
+
+    if args.redis_host:
+        os.environ['REDIS_HOST'] = args.redis_host
+
+
+def write_wav(path, seconds):
+    from server.audio import write_wav as write
+    rate = 44100
+    t = np.arange(int(rate * seconds)) / rate
+    tone = 0.3 * np.sin(2 * np.pi * 261.63 * t).astype(np.float32)
+    write(path, np.stack([tone, tone], axis=1), rate)
+
+
+class FakeContainers:
+    def __init__(self, delays, seconds):
+        from server import consts
+        self.consts = consts
+        self.delays = delays
+        self.seconds = seconds
+        self.started = []
+
+    def list(self, all=False, filters=None):
+        return []
+
+    def run(self, image, command=None, volumes=None, detach=False, labels=None, **kwargs):
+        if detach:
+            # a pooled container; its jobs come in through exec_run
+            self.started.append(image)
+            return FakeContainer(self, image, volumes, labels)
+
+        mounts = dict(reversed(v.split(':')[:2]) for v in volumes or [])
+        args = [self.host_path(a, mounts) for a in shlex.split(command or '')]
+        consts = self.consts
+
+        if image == consts.YTDLP_IMAGE:
+            self.sleep('ytdlp')
+            out = args[args.index('-o') + 1]
+            if '--write-info-json' in args:
+                info = dict(title=f'Bench Song {os.path.basename(out)}', duration=180, duration_string='3:00',
+                            thumbnails=[dict(height=180, width=320, url='https://i.ytimg.com/vi/x/mqdefault.jpg')])
+                with open(f'{out}.info.json', 'w') as f:
+                    json.dump(info, f)
+            else:
+                write_wav(out, self.seconds)
+
+        elif image == consts.KEYDETECT_IMAGE:
+            self.sleep('keydetect')
+            with open(args[-1], 'w') as f:
+                json.dump(dict(key='C', scale='major'), f)
+
+        elif image == consts.SPLEETER_IMAGE:
+            self.sleep('spleeter')
+            out_dir = args[args.index('-o') + 1]
+            for in_file in args[args.index('-o') + 2:]:
+                stems = os.path.join(out_dir, os.path.splitext(os.path.basename(in_file))[0])
+                os.makedirs(stems, exist_ok=True)
+                shutil.copy(in_file, os.path.join(stems, 'accompaniment.wav'))
+                shutil.copy(in_file, os.path.join(stems, 'vocals.wav'))
+
+        elif image == consts.RUBBERBAND_IMAGE:
+            self.sleep('rubberband')
+            shutil.copy(args[-2], args[-1])
+
+    def sleep(self, name):
+        time.sleep(self.delays.get(name, 0))
+
+    @staticmethod
+    def host_path(arg, mounts):
+        for container_path, host_path in mounts.items():
+            if arg == container_path or arg.startswith(container_path + '/'):
+                return host_path + arg[len(container_path):]
+        return arg
+
+
+class FakeContainer:
+    def __init__(self, containers, image, volumes, labels):
+        self.containers = containers
+        self.image = image
+        self.volumes = volumes
+        self.labels = labels or {}
+        self.id = self.short_id = f'{image}-{len(containers.started)}'
+        self.status = 'running'
+
+    def exec_run(self, cmd, **kwargs):
+        self.containers.run(self.image, command=shlex.join(cmd), volumes=self.volumes)
+        return 0, b''
+
+    def reload(self):
+        pass
+
+    def remove(self, force=False):
+        self.status = 'removed'
+
+
+class FakeImages:
+    def get(self, image):
+        # entrypoints are left out, so an exec carries the same arguments a one-shot run would
+        return type('Image', (), dict(attrs={'Config': {'Entrypoint': None}}))
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve_fixture(root, seconds):
+    # with FETCH_FUSED, yt_dlp's generic extractor fetches a wav from here instead of youtube
+    os.makedirs(root)
+    write_wav(os.path.join(root, 'song.wav'), seconds)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}/song.wav'
+
+
+class FakeDocker:
+    def __init__(self, delays, seconds):
+        self.containers = FakeContainers(delays, seconds)
+        self.images = FakeImages()
+
+
+class FakeS3:
+    def __init__(self, root, delay):
+        self.root = root
+        self.delay = delay
+
+    def upload_file(self, path, bucket, name, Config=None):
+        time.sleep(self.delay)
+        shutil.copy(path, os.path.join(self.root, name))
+
+    def upload_fileobj(self, stream, bucket, name, Config=None):
+        time.sleep(self.delay)
+        with open(os.path.join(self.root, name), 'wb') as f:
+            shutil.copyfileobj(stream, f)
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statuses = defaultdict(dict)
+        self.service = defaultdict(list)
+
+    def status(self, model, status):
+        key = (model.__class__.__name__, model.id)
+        with self.lock:
+            self.statuses[key].setdefault(status.name, time.perf_counter())
+
+    def job(self, channel, seconds):
+        with self.lock:
+            self.service[channel].append(seconds)
+
+
+def instrument(recorder):
+    from server.db import Track, TrackFile
+    from server.task import Task
+
+    for model in [Track, TrackFile]:
+        def set_status(self, status, _set_status=model.set_status):
+            recorder.status(self, status)
+            return _set_status(self, status)
+
+        model.set_status = set_status
+
+    prep_files = TrackFile.prep_files
+
+    def recorded_prep_files(track, specs):
+        track_files = prep_files(track, specs)
+        for track_file in track_files:
+            recorder.status(track_file, track_file.status)
+        return track_files
+
+    TrackFile.prep_files = staticmethod(recorded_prep_files)
+
+    start = Task.start
+
+    def timed_start(self, model, opts=None):
+        started = time.perf_counter()
+        try:
+            return start(self, model, opts)
+        finally:
+            recorder.job(self.channel, time.perf_counter() - started)
+
+    Task.start = timed_start
+
+
+def build_tasks(delays, seconds):
+    import docker
+    docker.from_env = lambda: FakeDocker(delays, seconds)
+
+    from server import consts, encode
+    from server.cleanup import CleanupTask
+    from server.download import DownloadTask
+    from server.keydetect import KeyTask
+    from server.metadata import MetadataTask
+    from server.rubberband import RubberbandTask, RubberbandBatchTask
+    from server.spleet import SpleetTask
+    from server.upload import UploadTask
+
+    def fake_encode(self, track_file, audio):
+        time.sleep(delays.get('ffmpeg', 0))
+        outfile = os.path.join(os.path.dirname(audio), track_file.nice_name())
+        shutil.copy(audio, outfile)
+        return outfile
+
+    encode.EncodeTask.encode = fake_encode
+
+    s3 = FakeS3(os.environ['BENCH_S3_DIR'], delays.get('s3', 0))
+    rekey = RubberbandBatchTask() if consts.REKEY_BATCH else RubberbandTask()
+    fetch = [MetadataTask(), DownloadTask()]
+    if consts.FETCH_FUSED:
+        from server import fetch as fused
+
+        # the fixture is already a wav, so there's nothing for ffmpeg to extract
+        ytdl_options = fused.ytdl_options
+        fused.ytdl_options = lambda base: dict(ytdl_options(base), postprocessors=[])
+        fetch = [fused.FetchTask()]
+
+    return fetch + [KeyTask(), SpleetTask(), rekey, encode.EncodeTask(), UploadTask(s3=s3), CleanupTask()]
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not values:
+        return ['-'] * len(points)
+    return [f'{np.percentile(values, p):.2f}' for p in points]
+
+
+def report(recorder, tracks, started, finished, tasks):
+    from server.db import Track, TrackStatus
+
+    print(f"\n{'stage':12} {'jobs':>5} {'svc mean':>9} {'svc p50':>8} {'svc p95':>8} {'wait p50':>9} {'wait p95':>9}")
+    for label, model, waiting, working in STAGES:
+        service = recorder.service.get(label) or recorder.service.get(f'{label}_batch') or []
+        waits = [times[working] - times[waiting] for (name, _), times in recorder.statuses.items()
+                 if name == model and waiting in times and working in times]
+        mean = f'{np.mean(service):.2f}' if service else '-'
+        svc = percentiles(service, (50, 95))
+        wait = percentiles(waits, (50, 95))
+        print(f'{label:12} {len(service):5} {mean:>9} {svc[0]:>8} {svc[1]:>8} {wait[0]:>9} {wait[1]:>9}')
+
+    done = [t for t in Track.select().where(Track.id.in_([t.id for t in tracks]))
+            if t.is_status(TrackStatus.DONE)]
+    latencies = [recorder.statuses[('Track', t.id)]['DONE'] - recorder.statuses[('Track', t.id)]['QUEUED']
+                 for t in done if 'DONE' in recorder.statuses[('Track', t.id)]]
+    elapsed = finished - started
+
+    p50, p90, p99 = percentiles(latencies)
+    unfinished = Track.select().where(Track.id.in_([t.id for t in tracks]), Track.status != TrackStatus.DONE)
+    stuck = defaultdict(int)
+    for track in unfinished:
+        stuck[track.status.name] += 1
+
+    print(f'\ntracks done: {len(done)}/{len(tracks)} in {elapsed:.1f}s')
+    if stuck:
+        print('not done: ' + ', '.join(f'{count} {status}' for status, count in sorted(stuck.items())))
+    print(f'end-to-end latency p50 {p50}s  p90 {p90}s  p99 {p99}s')
+    print(f'throughput: {len(done) / elapsed * 3600:.0f} tracks/hour')
+
+    pools = [pool for task in tasks for pool in task.pools.values()]
+    if pools:
+        print(f"\n{'pool':24} {'phase':8} {'samples':>7} {'mean ms':>8} {'p95 ms':>8}")
+        for pool in pools:
+            for phase, times in sorted(pool.timings.items()):
+                times = np.array(times) * 1000
+                print(f'{pool.image[:24]:24} {phase:8} {len(times):7} {times.mean():8.1f} {np.percentile(times, 95):8.1f}')
+
+
+def main():
+    args = parse_args()
+    delays = {k: float(v) for k, v in (d.split('=') for d in args.delay)}
+    scratch = tempfile.mkdtemp(prefix='rekey-bench-')
+    configure(args, scratch)
+
+    if not args.redis_host:
+        try:
+            import fakeredis
+        except ImportError:
+            print('install fakeredis or pass --redis-host')
+            sys.exit(1)
+
+        class BlockingFakeRedis(fakeredis.FakeStrictRedis):
+            # fakeredis answers blocking pops immediately, which would turn every watch loop into a spin
+            def blmove(self, first_list, second_list, timeout, src='LEFT', dest='RIGHT'):
+                deadline = time.perf_counter() + timeout
+                while True:
+                    value = self.lmove(first_list, second_list, src, dest)
+                    if value or time.perf_counter() > deadline:
+                        return value
+                    time.sleep(0.005)
+
+            def blpop(self, keys, timeout=0):
+                deadline = time.perf_counter() + timeout
+                while True:
+                    value = self.lpop(keys)
+                    if value or time.perf_counter() > deadline:
+                        return (keys, value) if value else None
+                    time.sleep(0.005)
+
+        import redis.client
+        fake_server = fakeredis.FakeServer()
+        redis.client.StrictRedis = lambda host=None, **kwargs: BlockingFakeRedis(server=fake_server)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    recorder = Recorder()
+    instrument(recorder)
+    tasks = build_tasks(delays, args.seconds)
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    red = tasks[0].redis
+
+    from peewee import OperationalError
+    from server.consts import FETCH_FUSED
+    from server.db import User, Track, TrackStatus
+
+    fixture = serve_fixture(os.path.join(scratch, 'fixture'), args.seconds) if FETCH_FUSED else None
+
+    for task in tasks:
+        threading.Thread(target=task.watch, daemon=True).start()
+
+    user = User.create(username='bench')
+    started = time.perf_counter()
+    tracks = []
+    for i in range(args.tracks):
+        url = f'{fixture}?bench={i}' if fixture else f'https://www.youtube.com/watch?v=bench{i:06d}'
+        track = Track(url=url, flags=args.flags, user=user, status=TrackStatus.QUEUED)
+        track.save()
+        recorder.status(track, TrackStatus.QUEUED)
+        track.next_status(red)
+        tracks.append(track)
+
+    finished_statuses = [TrackStatus.DONE, TrackStatus.ERROR, TrackStatus.REJECTED]
+    while time.perf_counter() - started < args.timeout:
+        time.sleep(0.2)
+        try:
+            if not Track.select().where(Track.status.not_in(finished_statuses)).count():
+                break
+        except OperationalError as e:
+            # contention on the shared sqlite file is part of what this measures
+            print(f'poll failed: {e}')
+
+    report(recorder, tracks, started, time.perf_counter(), tasks)
+    shutil.rmtree(scratch, ignore_errors=True)
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# usage: bench_db.py --processes 11 --threads 4 --updates 200
+# hammers one sqlite file the way the workers do (small status writes, file listings for polls) from many
+# processes, once per mode, and reports write latency, throughput and 'database is locked' errors.
+
+MODES = {
+    # the old setup: rollback journal, full sync, sqlite3's 5s timeout, a transaction per write
+    'legacy': dict(DB_JOURNAL_MODE='delete', DB_SYNCHRONOUS='full', DB_BUSY_TIMEOUT_MS='5000', DB_GROUP_COMMIT='0'),
+    'wal': dict(DB_JOURNAL_MODE='wal', DB_SYNCHRONOUS='normal', DB_GROUP_COMMIT='0'),
+    'wal+group': dict(DB_JOURNAL_MODE='wal', DB_SYNCHRONOUS='normal', DB_GROUP_COMMIT='1'),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=11, help='worker processes, one track each')
+    parser.add_argument('--threads', type=int, default=4, help='threads per process, like <QUEUE>_CONCURRENCY')
+    parser.add_argument('--files', type=int, default=24, help='files per track')
+    parser.add_argument('--updates', type=int, default=200, help='status writes per thread')
+    parser.add_argument('--read-every', type=int, default=5, help='list a track\'s files every N writes')
+    parser.add_argument('--mode', action='append', choices=list(MODES), help='default: all of them')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for each mode\'s workers')
+    return parser.parse_args()
+
+
+def load(env):
+    # consts are read at import time, so the mode's env goes in before importing server modules
+    os.environ.update(env)
+    import server.db
+
+    # no redis here, and status events are not what's measured
+    server.db.publish = lambda track_id, version: None
+    logging.getLogger().setLevel(logging.WARNING)
+    return server.db
+
+
+def seed(env, args, results):
+    db = load(env)
+    user = db.User.create(username='bench')
+    track_ids = []
+    for n in range(args.processes):
+        track = db.Track.create(url=f'bench-{n}', user=user, title=f'bench {n}', key='C', quality='major',
+                                 status=db.TrackStatus.NEEDS_REKEY)
+        for offset in range(args.files):
+            db.TrackFile.create(track=track, key_offset=offset, file_type=db.FileType.NORMAL_AUDIO,
+                                status=db.FileStatus.QUEUED)
+        track_ids.append(track.id)
+
+    results.put(track_ids)
+
+
+def worker(env, track_id, args, ready, go, results):
+    db = load(env)
+    track = db.Track.get_by_id(track_id)
+    files = list(db.TrackFile.select().where(db.TrackFile.track == track))
+    statuses = list(db.FileStatus)
+
+    def run(mine):
+        latencies, errors = [], 0
+        with db.db.connection_context():
+            for i in range(args.updates):
+                track_file = mine[i % len(mine)]
+                started = time.perf_counter()
+                try:
+                    track_file.set_status(statuses[i % len(statuses)])
+                    latencies.append(time.perf_counter() - started)
+                    if i % args.read_every == 0:
+                        db.files_data_for(track)
+                except db.OperationalError:
+                    errors += 1
+
+        return latencies, errors
+
+    ready.put(track_id)
+    go.wait()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        outcomes = list(pool.map(run, [files[n::args.threads] for n in range(args.threads)]))
+
+    results.put(([t for latencies, _ in outcomes for t in latencies], sum(errors for _, errors in outcomes)))
+
+
+def bench(mode, args, scratch):
+    ctx = multiprocessing.get_context('spawn')
+    env = dict(MODES[mode], DATABASE_FILE=os.path.join(scratch, f'{mode}.db'))
+
+    results = ctx.Queue()
+    setup = ctx.Process(target=seed, args=(env, args, results))
+    setup.start()
+    setup.join()
+    if setup.exitcode:
+        raise SystemExit(f'seeding the {mode} db failed')
+    track_ids = results.get()
+
+    ready, go = ctx.Queue(), ctx.Event()
+    procs = [ctx.Process(target=worker, args=(env, track_id, args, ready, go, results)) for track_id in track_ids]
+    for proc in procs:
+        proc.start()
+    for _ in procs:
+        ready.get()
+
+    started = time.perf_counter()
+    go.set()
+    try:
+        outcomes = [results.get(timeout=args.timeout) for _ in procs]
+    except Empty:
+        for proc in procs:
+            proc.kill()
+        raise SystemExit(f'{mode} workers did not finish')
+    elapsed = time.perf_counter() - started
+    for proc in procs:
+        proc.join()
+
+    latencies = np.array([t for times, _ in outcomes for t in times]) * 1000
+    errors = sum(errors for _, errors in outcomes)
+    p50, p99 = np.percentile(latencies, (50, 99)) if len(latencies) else (np.nan, np.nan)
+    print(f'{mode:10} {len(latencies):7} {errors:7} {len(latencies) / elapsed:9.0f} {p50:8.1f} {p99:8.1f} {elapsed:7.1f}')
+
+
+def main():
+    args = parse_args()
+    scratch = tempfile.mkdtemp(prefix='rekey-bench-db-')
+    print(f'{args.processes} processes x {args.threads} threads x {args.updates} status writes')
+    print(f"\n{'mode':10} {'writes':>7} {'locked':>7} {'writes/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'secs':>7}")
+    try:
+        for mode in args.mode or list(MODES):
+            bench(mode, args, scratch)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import json
+import os
+import sys
+import tempfile
+import time
+
+import docker
+
+from server.consts import KEYDETECT_IMAGE, KEYDETECT_MIN_STRENGTH
+from server.hpcp import detect_key, detect_key_progressive
+from server.task import volume
+from server.util import fix_key
+
+# usage: bench_keydetect.py song.wav [song.wav ...]
+# times the numpy engine, in full and progressive mode, against the essentia key-detect container on the same files
+
+
+def run_numpy(path):
+    key, scale, _, _ = detect_key(path)
+    return fix_key(key), scale
+
+
+def run_progressive(path):
+    key, scale, _, _ = detect_key_progressive(path, KEYDETECT_MIN_STRENGTH)
+    return fix_key(key), scale
+
+
+def run_essentia(client, path):
+    with tempfile.TemporaryDirectory() as output_dir:
+        volumes = [
+            volume(os.path.dirname(os.path.abspath(path)), '/input'),
+            volume(output_dir, '/output'),
+        ]
+        command = f"/input/{os.path.basename(path)} /output/key.json"
+        client.containers.run(KEYDETECT_IMAGE, command=command, remove=True, volumes=volumes)
+
+        with open(os.path.join(output_dir, 'key.json')) as f:
+            data = json.load(f)
+
+    return fix_key(data.get('key')), data.get('scale')
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def main(paths):
+    client = docker.from_env()
+    totals = dict(numpy=0.0, progressive=0.0, essentia=0.0)
+    agreed = progressive_agreed = 0
+
+    print(f"{'file':40} {'numpy':>14} {'progressive':>14} {'essentia':>14} {'np s':>7} {'prog s':>7} {'ess s':>7}")
+    for path in paths:
+        numpy_key, numpy_time = timed(run_numpy, path)
+        progressive_key, progressive_time = timed(run_progressive, path)
+        essentia_key, essentia_time = timed(run_essentia, client, path)
+        totals['numpy'] += numpy_time
+        totals['progressive'] += progressive_time
+        totals['essentia'] += essentia_time
+        agreed += numpy_key == essentia_key
+        progressive_agreed += progressive_key == numpy_key
+
+        print(f"{os.path.basename(path)[:40]:40} {' '.join(numpy_key):>14} {' '.join(progressive_key):>14} "
+              f"{' '.join(essentia_key):>14} {numpy_time:7.2f} {progressive_time:7.2f} {essentia_time:7.2f}")
+
+    count = len(paths)
+    print(f"\nagreement: {agreed}/{count} ({100 * agreed / count:.0f}%), "
+          f"progressive with full: {progressive_agreed}/{count}")
+    print(f"numpy: {totals['numpy']:.2f}s  progressive: {totals['progressive']:.2f}s  essentia: {totals['essentia']:.2f}s  "
+          f"speedup: {totals['essentia'] / max(totals['numpy'], 1e-9):.1f}x")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"usage: {sys.argv[0]} song.wav [song.wav ...]")
+        sys.exit(1)
+    main(sys.argv[1:])
@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta
+
+from server.consts import RESULT_CACHE, RESULT_CACHE_SECONDS, RESULT_CACHE_STALE_SECONDS
+from server.db import Track, TrackFile, TrackFlags, TrackStatus, FileStatus
+from server.log import logger
+from server.util import make_key, video_id
+
+# flags that change what the pipeline produces; PRIVATE and NOVOX_FIRST don't
+OUTPUT_FLAGS = [TrackFlags.SKIP_SPLIT, TrackFlags.SKIP_REKEY, TrackFlags.REKEY_COMMON]
+
+
+def cache_key(track):
+    vid = video_id(track.url)
+    if not RESULT_CACHE or not vid:
+        return None
+
+    # a lazy track renders keys on demand from its own sources, which a linked track doesn't have
+    if track.has_flag(TrackFlags.REKEY_LAZY):
+        return None
+
+    flags = sum(flag.value for flag in OUTPUT_FLAGS if track.has_flag(flag))
+    return make_key('cache', vid, flags)
+
+
+def follow(track, red):
+    # True if the track was satisfied by, or queued behind, an earlier run of the same video
+    key = cache_key(track)
+    if not key:
+        return False
+
+    if red.set(key, track.id, nx=True, ex=RESULT_CACHE_SECONDS):
+        return False
+
+    try:
+        source = Track.get_by_id(int(red.get(key)))
+    except (TypeError, ValueError, Track.DoesNotExist):
+        red.set(key, track.id, ex=RESULT_CACHE_SECONDS)
+        return False
+
+    if source.is_status(TrackStatus.ERROR) or is_stale(source):
+        # whoever already follows a stale run is settled by this one, they share the followers list
+        red.set(key, track.id, ex=RESULT_CACHE_SECONDS)
+        return False
+
+    followers = followers_key(key)
+    red.rpush(followers, track.id)
+    red.expire(followers, RESULT_CACHE_SECONDS)
+    logger.info("%s follows %s", track, source)
+
+    # the source may have settled before we joined its followers, so look again now that we have
+    try:
+        source = Track.get_by_id(source.id)
+    except Track.DoesNotExist:
+        red.lrem(followers, 1, track.id)
+        return False
+
+    if source.is_status([TrackStatus.DONE, TrackStatus.REJECTED, TrackStatus.ERROR]):
+        settle(source, red)
+
+    return True
+
+
+def is_stale(source):
+    if source.is_status([TrackStatus.DONE, TrackStatus.REJECTED]):
+        return False
+    return source.updated < datetime.now() - timedelta(seconds=RESULT_CACHE_STALE_SECONDS)
+
+
+def settle(track, red):
+    key = cache_key(track)
+    if not key:
+        return
+
+    # an expired key still leaves followers to settle, a key taken over by a newer run hands them to it
+    owner = red.get(key)
+    if owner is not None and owner != str(track.id).encode('utf-8'):
+        return
+
+    if track.is_status(TrackStatus.ERROR):
+        red.delete(key)
+
+    followers = followers_key(key)
+    while True:
+        follower_id = red.lpop(followers)
+        if not follower_id:
+            break
+
+        try:
+            follower = Track.get_by_id(int(follower_id))
+        except Track.DoesNotExist:
+            continue
+
+        if track.is_status(TrackStatus.ERROR):
+            if not follow(follower, red):
+                follower.next_status(red)
+            continue
+
+        link(track, follower)
+
+
+def link(source, track):
+    track.title = source.title
+    track.thumbnail = source.thumbnail
+    track.duration = source.duration
+    track.key = source.key
+    track.quality = source.quality
+
+    track_files = TrackFile.select().where(
+        TrackFile.track == source,
+        TrackFile.status == FileStatus.DONE
+    )
+    for track_file in track_files:
+        TrackFile.create(
+            track=track.id,
+            key_offset=track_file.key_offset,
+            file_type=track_file.file_type,
+            file_url=track_file.file_url,
+            status=FileStatus.DONE
+        )
+
+    track.set_status(source.status)
+    logger.info("%s linked to the results of %s", track, source)
+
+
+def followers_key(key):
+    return make_key(key, 'followers')
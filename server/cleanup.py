@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 import os
+import threading
+import time
+from datetime import datetime, timedelta
 
-from server.consts import YTDLP_OUTPUT_DIR, SPLEETER_OUTPUT_DIR, RUBBERBAND_OUTPUT_DIR, KEYDETECT_OUTPUT_DIR
-from server.db import Queue, Track, TrackStatus, TrackFile
+from server.audio import pcm_path
+from server.cache import settle
+from server.consts import YTDLP_OUTPUT_DIR, SPLEETER_OUTPUT_DIR, RUBBERBAND_OUTPUT_DIR, KEYDETECT_OUTPUT_DIR, \
+    LAZY_SOURCE_DAYS, LAZY_SOURCE_BUDGET_MB, LAZY_SWEEP_SECONDS
+from server.db import db, Queue, Track, TrackStatus, TrackFile, TrackFlags, commit
 from server.log import logger
 from server.task import Task
 
@@ -17,45 +23,129 @@ class CleanupTask(Task):
 
         files = [
             (YTDLP_OUTPUT_DIR, f"{track.id}.info.json"),
-            (YTDLP_OUTPUT_DIR, f"{track.id}.wav"),
-            (SPLEETER_OUTPUT_DIR, str(track.id), 'accompaniment.wav'),
             (SPLEETER_OUTPUT_DIR, str(track.id), 'vocals.wav'),
-            (SPLEETER_OUTPUT_DIR, str(track.id)),
             (KEYDETECT_OUTPUT_DIR, f"{track.id}.key.json")
         ]
 
+        # a lazy track renders more keys later, from the same sources
+        if not track.has_flag(TrackFlags.REKEY_LAZY):
+            files += [
+                (YTDLP_OUTPUT_DIR, f"{track.id}.wav"),
+                (YTDLP_OUTPUT_DIR, f"{track.id}.pcm"),
+                (SPLEETER_OUTPUT_DIR, str(track.id), 'accompaniment.wav'),
+                (SPLEETER_OUTPUT_DIR, str(track.id), 'accompaniment.pcm'),
+            ]
+
+        # the original keys are encoded next to their sources
         track_files = TrackFile.select().where(TrackFile.track == track)
         for track_file in track_files:
             for ext in ['mp3', 'wav']:
                 nice_name = track_file.nice_name(ext=ext)
                 files.append((RUBBERBAND_OUTPUT_DIR, nice_name))
                 files.append((YTDLP_OUTPUT_DIR, nice_name))
+                files.append((SPLEETER_OUTPUT_DIR, str(track.id), nice_name))
+
+        # last, once it's empty
+        if not track.has_flag(TrackFlags.REKEY_LAZY):
+            files.append((SPLEETER_OUTPUT_DIR, str(track.id)))
 
-        for path_parts in files:
-            path = os.path.join(*path_parts)
-            if os.path.isfile(path):
-                try:
-                    os.remove(path)
-                    logger.info(f"Removed {path}")
-                except Exception as e:
-                    logger.warn(f"Can't remove {path}")
-                    logger.exception(e)
-                    pass
-                continue
-
-            if os.path.isdir(path) and len(path) > 10:
-                try:
-                    os.removedirs(path)
-                    logger.info(f"Removed {path}")
-                except Exception as e:
-                    logger.warn(f"Can't remove {path}")
-                    logger.exception(e)
-                    pass
-                continue
+        remove_paths([os.path.join(*path_parts) for path_parts in files])
 
         if not track.is_status(TrackStatus.ERROR):
             track.set_status(TrackStatus.DONE)
 
+        settle(track, self.redis)
+        evict_sources()
+
+    def watch(self):
+        threading.Thread(target=self.sweep, daemon=True).start()
+        super(CleanupTask, self).watch()
+
+    def sweep(self):
+        # a quiet server still lets old sources age out
+        while True:
+            try:
+                with db.connection_context():
+                    evict_sources()
+            except Exception as e:
+                logger.exception(e)
+
+            time.sleep(LAZY_SWEEP_SECONDS)
+
+
+def remove_paths(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            try:
+                os.remove(path)
+                logger.info(f"Removed {path}")
+            except Exception as e:
+                logger.warn(f"Can't remove {path}")
+                logger.exception(e)
+                pass
+            continue
+
+        if os.path.isdir(path) and len(path) > 10:
+            try:
+                os.rmdir(path)
+                logger.info(f"Removed {path}")
+            except Exception as e:
+                logger.warn(f"Can't remove {path}")
+                logger.exception(e)
+                pass
+            continue
+
+
+# a track that's rekeying or cleaning up is still using its sources
+SETTLED = [TrackStatus.DONE, TrackStatus.ERROR]
+
+
+def evict_sources(now=None):
+    # lazy tracks' sources, most recently used first; the ones past the age limit or over the budget go
+    cutoff = (now or datetime.now()) - timedelta(days=LAZY_SOURCE_DAYS)
+    budget = LAZY_SOURCE_BUDGET_MB * 1024 * 1024
+    used = 0
+
+    tracks = Track.select().where(
+        Track.flags.bin_and(TrackFlags.REKEY_LAZY.value) != 0,
+        Track.status.in_(SETTLED)
+    ).order_by(Track.updated.desc(), Track.id.desc())
+
+    for track in tracks:
+        paths = source_paths(track)
+        size = sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+        if not size:
+            continue
+
+        if track.updated >= cutoff and used + size <= budget:
+            used += size
+            continue
+
+        evict(track, paths)
+
+
+def evict(track, paths):
+    # under the write lock, so a render request either reopened the track first or finds the sources gone
+    def write():
+        with db.atomic('IMMEDIATE'):
+            if not Track.select().where(Track.id == track.id, Track.status.in_(SETTLED)).exists():
+                return False
+            remove_paths(paths)
+            return True
+
+    if commit(write):
+        logger.info("Evicted the sources of %s", track)
+
+
+def source_paths(track):
+    paths = []
+    for source in track.source_files():
+        paths += [source, pcm_path(source)]
+    # the split's dir goes last, once it's empty
+    if not track.has_flag(TrackFlags.SKIP_SPLIT):
+        paths.append(os.path.join(SPLEETER_OUTPUT_DIR, str(track.id)))
+    return paths
+
 
 if __name__ == '__main__':
     CleanupTask().watch()
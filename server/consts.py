@@ -7,23 +7,77 @@ VOLUME_BASE = '/opt/volumes/rekey'
 DOCKER_USER = 1000
 
 S3_BUCKET = env('S3_BUCKET', 'spleet.bbby.org')
+RESULT_CACHE = env('RESULT_CACHE', '1') == '1'
+RESULT_CACHE_SECONDS = int(env('RESULT_CACHE_SECONDS', 7 * 24 * 60 * 60))
+# a run of a video that hasn't moved for this long stops collecting followers, the next request runs it again
+RESULT_CACHE_STALE_SECONDS = int(env('RESULT_CACHE_STALE_SECONDS', 6 * 60 * 60))
+POLL_CACHE_SECONDS = int(env('POLL_CACHE_SECONDS', 5 * 60))
+S3_ENDPOINT_URL = env('S3_ENDPOINT_URL')
+S3_MAX_POOL_CONNECTIONS = int(env('S3_MAX_POOL_CONNECTIONS', 32))
+S3_MULTIPART_CHUNK_SIZE = int(env('S3_MULTIPART_CHUNK_SIZE', 8 * 1024 * 1024))
+S3_MAX_CONCURRENCY = int(env('S3_MAX_CONCURRENCY', 4))
+ENCODE_BATCH = env('ENCODE_BATCH', '0') == '1'
+ENCODE_BATCH_THREADS = int(env('ENCODE_BATCH_THREADS', os.cpu_count()))
+UPLOAD_BATCH = env('UPLOAD_BATCH', '0') == '1'
+UPLOAD_BATCH_THREADS = int(env('UPLOAD_BATCH_THREADS', 8))
 DATABASE_FILE = env('DATABASE_FILE', 'app.db')
+DB_JOURNAL_MODE = env('DB_JOURNAL_MODE', 'wal')
+DB_SYNCHRONOUS = env('DB_SYNCHRONOUS', 'normal')
+DB_BUSY_TIMEOUT_MS = int(env('DB_BUSY_TIMEOUT_MS', 30 * 1000))
+DB_GROUP_COMMIT = env('DB_GROUP_COMMIT', '1') == '1'
+DB_COMMIT_WINDOW_MS = int(env('DB_COMMIT_WINDOW_MS', 0))
 
 YTDLP_IMAGE = env('YTDLP_IMAGE', 'thr3a/yt-dlp')
 YTDLP_OUTPUT_DIR = env('YTDLP_OUTPUT_DIR', VOLUME_BASE + '/ytdlp')
+FETCH_FUSED = env('FETCH_FUSED', '0') == '1'
 
 SPLEETER_IMAGE = env('SPLEETER_IMAGE', 'deezer/spleeter:3.8-2stems')
 SPLEETER_INPUT_DIR = env('SPLEETER_INPUT_DIR', YTDLP_OUTPUT_DIR)
 SPLEETER_OUTPUT_DIR = env('SPLEETER_OUTPUT_DIR', VOLUME_BASE + '/spleets')
+SPLEETER_SERVICE = env('SPLEETER_SERVICE', '0') == '1'
+SPLEETER_QUEUE = env('SPLEETER_QUEUE', 'spleeter:jobs')
+SPLEETER_TIMEOUT = int(env('SPLEETER_TIMEOUT', 15 * 60))
+# tracks separated per spleeter run, and how long to wait for more after the first
+SPLEETER_BATCH_SIZE = int(env('SPLEETER_BATCH_SIZE', 1))
+SPLEETER_BATCH_WINDOW_MS = int(env('SPLEETER_BATCH_WINDOW_MS', 2000))
 
 KEYDETECT_IMAGE = env('KEYDETECT_IMAGE', 'key-detect')
 KEYDETECT_INPUT_DIR = env('KEYDETECT_INPUT_DIR', YTDLP_OUTPUT_DIR)
 KEYDETECT_OUTPUT_DIR = env('KEYDETECT_OUTPUT_DIR', VOLUME_BASE + '/keydetect')
+KEYDETECT_ENGINE = env('KEYDETECT_ENGINE', 'container')
+KEYDETECT_MODE = env('KEYDETECT_MODE', 'full')
+KEYDETECT_MIN_STRENGTH = float(env('KEYDETECT_MIN_STRENGTH', 0.6))
 
 RUBBERBAND_IMAGE = env('RUBBERBAND_IMAGE', 'rubberband')
 RUBBERBAND_INPUT_DIR = env('RUBBERBAND_INPUT_DIR', YTDLP_OUTPUT_DIR)
 RUBBERBAND_SPLITS_DIR = env('RUBBERBAND_SPLITS_DIR', SPLEETER_OUTPUT_DIR)
 RUBBERBAND_OUTPUT_DIR = env('RUBBERBAND_OUTPUT_DIR', VOLUME_BASE + '/rubberband')
 
+REKEY_BATCH = env('REKEY_BATCH', '0') == '1'
+REKEY_WORKERS = int(env('REKEY_WORKERS', os.cpu_count()))
+REKEY_FUSED = env('REKEY_FUSED', '0') == '1'
+# float32 copies of the downloaded and split wavs, for the in-process engines to map
+PCM_STORE = env('PCM_STORE', '0') == '1'
+# a lazy track keeps its sources for more keys; the least recently used go once they are too old or too many
+LAZY_SOURCE_DAYS = int(env('LAZY_SOURCE_DAYS', 14))
+LAZY_SOURCE_BUDGET_MB = int(env('LAZY_SOURCE_BUDGET_MB', 10 * 1024))
+LAZY_SWEEP_SECONDS = int(env('LAZY_SWEEP_SECONDS', 60 * 60))
+
 REDIS_HOST = env('REDIS_HOST', 'localhost')
 REDIS_KEY_SEPERATOR = ':'
+EVENTS_CHANNEL = env('EVENTS_CHANNEL', 'track:events')
+SSE_KEEPALIVE_SECONDS = int(env('SSE_KEEPALIVE_SECONDS', 15))
+WEB_SERVER = env('WEB_SERVER', 'flask')
+
+QUEUE_BLOCK_TIMEOUT = int(env('QUEUE_BLOCK_TIMEOUT', 5))
+QUEUE_LEASE_SECONDS = int(env('QUEUE_LEASE_SECONDS', 60))
+QUEUE_PREFETCH = int(env('QUEUE_PREFETCH', 0))
+CONTAINER_POOL = env('CONTAINER_POOL', '0') == '1'
+CONTAINER_POOL_MAX_JOBS = int(env('CONTAINER_POOL_MAX_JOBS', 50))
+CONTAINER_POOL_TIMINGS = int(env('CONTAINER_POOL_TIMINGS', 1000))
+FAIR_QUEUES = [q for q in env('FAIR_QUEUES', 'rekey').split(',') if q]
+FAIR_MAX_WAIT = int(env('FAIR_MAX_WAIT', 5 * 60))
+
+
+def concurrency_for(channel):
+    return max(1, int(env(f'{channel.upper()}_CONCURRENCY', 1)))
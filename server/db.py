@@ -8,15 +8,29 @@ from uuid import uuid4
 from flask_login import UserMixin
 from peewee import *
 
-from server.consts import ORIGINAL_KEY, S3_BUCKET, DATABASE_FILE
+from server.consts import ORIGINAL_KEY, S3_BUCKET, DATABASE_FILE, REKEY_BATCH, UPLOAD_BATCH, \
+    ENCODE_BATCH, DB_JOURNAL_MODE, DB_SYNCHRONOUS, DB_BUSY_TIMEOUT_MS, DB_GROUP_COMMIT, DB_COMMIT_WINDOW_MS, \
+    YTDLP_OUTPUT_DIR, SPLEETER_OUTPUT_DIR
+from server.errs import JobError
+from server.events import publish
+from server.jobs import job_queue
 from server.log import logger
-from server.util import key_for, signed, offset_key, primitives
+from server.migrations import migrate
+from server.util import key_for, signed, offset_key, primitives, make_key
+from server.writes import GroupCommit
 
 db_file = DATABASE_FILE
-db = SqliteDatabase(db_file)
+db = SqliteDatabase(db_file, timeout=DB_BUSY_TIMEOUT_MS / 1000, pragmas={
+    'journal_mode': DB_JOURNAL_MODE,
+    'synchronous': DB_SYNCHRONOUS,
+    'busy_timeout': DB_BUSY_TIMEOUT_MS,
+})
+group_commit = GroupCommit(db, DB_COMMIT_WINDOW_MS / 1000)
 mktables = not os.path.isfile(db_file)
 
 COMMON_KEYS = ['F', 'C', 'G', 'D', 'A']
+# a lazy track renders any of these it skipped when someone asks for it
+KEY_OFFSETS = [k for k in range(-6, 7) if k != ORIGINAL_KEY]
 
 
 class EnumField(IntegerField, ABC):
@@ -79,6 +93,9 @@ class FileStatus(Enum):
     ERROR = 50
 
 
+SETTLED_FILE_STATUSES = [FileStatus.DONE, FileStatus.ERROR]
+
+
 class FileType(Enum):
     NORMAL_AUDIO = 0
     INSTRUMENTAL_AUDIO = 1
@@ -103,6 +120,7 @@ class Queue(Enum):
     KEY_DETECT = 'key_detect'
     SPLIT = 'spleet'
     REKEY = 'rekey'
+    REKEY_BATCH = 'rekey_batch'
     ENCODE = 'encode'
     UPLOAD = 'upload'
     CLEANUP = 'cleanup'
@@ -129,11 +147,12 @@ class TrackFlags(Enum):
     RESTITCH_VIDEO = 1 << 3
     REKEY_COMMON = 1 << 4
     NOVOX_FIRST = 1 << 5
+    REKEY_LAZY = 1 << 6
 
 
 class Track(BaseModel):
     url = CharField()
-    uuid = UUIDField(default=uuid4)
+    uuid = UUIDField(default=uuid4, unique=True)
     title = CharField(null=True)
     status = EnumField(TrackStatus)
     key = CharField(null=True)
@@ -143,6 +162,16 @@ class Track(BaseModel):
     flags = IntegerField(default=0)
     user = ForeignKeyField(User)
     error_message = CharField(null=True)
+    # files not yet DONE or ERROR
+    remaining = IntegerField(default=0)
+    # comma separated offsets a lazy track renders up front
+    offsets = CharField(null=True)
+    # how well the detected key's profile fit, from 0 to 1
+    key_strength = FloatField(null=True)
+
+    class Meta:
+        # a save must not write back a stale remaining count
+        only_save_dirty = True
 
     @property
     def status_enum(self):
@@ -153,8 +182,9 @@ class Track(BaseModel):
         return TrackStatus.ERROR
 
     def set_status(self, status):
+        previous = self.status
         self.status = status
-        self.save()
+        save_status(self, previous)
 
     def expect_status(self, status):
         if not self.is_status(status):
@@ -167,6 +197,10 @@ class Track(BaseModel):
 
     def next_status(self, red):
         status = self._next_status()
+        if status == self.status_enum.NEEDS_CLEANUP:
+            # files may still be encoding or uploading, whoever settles the last one queues cleanup
+            return cleanup_check(self, red)
+
         if status and status != self.status:
             self.set_status(status)
 
@@ -183,20 +217,15 @@ class Track(BaseModel):
                 return red.rpush(Queue.SPLIT.value, key_for(self))
 
             if status == self.status_enum.NEEDS_REKEY:
-                key_offsets = list(range(-6, 7))
-                # key_offsets = [-1, 1]
+                key_offsets = sorted(KEY_OFFSETS, key=lambda k: (abs(k) * 10) + int(k < 0))
 
-                key_offsets = sorted(key_offsets, key=lambda k: (abs(k) * 10) + int(k < 0))
-                key_offsets = [i for i in key_offsets if i != ORIGINAL_KEY]
-
-                if self.has_flag(TrackFlags.REKEY_COMMON):
+                if self.has_flag(TrackFlags.REKEY_LAZY):
+                    key_offsets = [k for k in key_offsets if k in self.eager_offsets()]
+                elif self.has_flag(TrackFlags.REKEY_COMMON):
                     key_offsets = [k for k in key_offsets if offset_key(self.key, k) in COMMON_KEYS]
 
-                do_splits = not self.has_flag(TrackFlags.SKIP_SPLIT)
-
-                keys = TrackFile.prepare(self, key_offsets, do_splits)
-                for key in keys:
-                    red.rpush(Queue.REKEY.value, key)
+                files = TrackFile.prepare(self, key_offsets, self.file_types())
+                queue_rekey(self, files, red)
 
     def _next_status(self):
         enums = self.status_enum
@@ -263,6 +292,42 @@ class Track(BaseModel):
     def has_flag(self, flag):
         return bool(self.flags & flag.value)
 
+    def file_types(self):
+        if self.has_flag(TrackFlags.SKIP_SPLIT):
+            return [FileType.NORMAL_AUDIO]
+        return [FileType.NORMAL_AUDIO, FileType.INSTRUMENTAL_AUDIO]
+
+    def eager_offsets(self):
+        # the offsets picked at submit time, else the ones landing on a common key
+        if self.offsets:
+            return [int(k) for k in self.offsets.split(',')]
+        return [k for k in KEY_OFFSETS if offset_key(self.key, k) in COMMON_KEYS]
+
+    def source_files(self):
+        # what rekeying renders from, kept after cleanup for a lazy track
+        sources = [os.path.join(YTDLP_OUTPUT_DIR, f'{self.id}.wav')]
+        if not self.has_flag(TrackFlags.SKIP_SPLIT):
+            sources.append(os.path.join(SPLEETER_OUTPUT_DIR, str(self.id), 'accompaniment.wav'))
+        return sources
+
+    def has_sources(self):
+        return all(os.path.isfile(path) for path in self.source_files())
+
+    def lazy_offsets(self):
+        # offsets a lazy track can still be asked to render
+        if not self.has_flag(TrackFlags.REKEY_LAZY) or self.has_flag(TrackFlags.SKIP_REKEY):
+            return []
+        if not self.has_sources():
+            return []
+
+        rendered = set()
+        track_files = TrackFile.select().where(TrackFile.track == self, TrackFile.status != FileStatus.ERROR)
+        for track_file in track_files:
+            rendered.add((track_file.key_offset, track_file.file_type))
+
+        types = self.file_types()
+        return [k for k in KEY_OFFSETS if any((k, t) not in rendered for t in types)]
+
 
 class TrackFile(BaseModel):
     track = ForeignKeyField(Track)
@@ -273,6 +338,11 @@ class TrackFile(BaseModel):
     uuid = UUIDField(default=uuid4())
     error_message = CharField(null=True)
 
+    class Meta:
+        indexes = (
+            (('track', 'key_offset', 'file_type'), True),
+        )
+
     def serial(self):
         data = primitives(self.__data__)
         data.update(dict(
@@ -296,8 +366,9 @@ class TrackFile(BaseModel):
         return FileStatus.ERROR
 
     def set_status(self, status):
+        previous = self.status
         self.status = status
-        self.save()
+        save_status(self, previous)
 
     def expect_status(self, status):
         if not self.is_status(status):
@@ -308,58 +379,66 @@ class TrackFile(BaseModel):
             status = [status]
         return self.status in status
 
+    def priority(self):
+        # lower goes first: nearest keys, up before down, normal before split. NOVOX_FIRST puts every split first
+        distance = abs(self.key_offset) * 2 + int(self.key_offset < 0)
+        split = self.is_type([FileType.INSTRUMENTAL_AUDIO, FileType.INSTRUMENTAL_VIDEO])
+        if self.track.has_flag(TrackFlags.NOVOX_FIRST):
+            return distance + (0 if split else 100)
+        return distance * 2 + int(split)
+
     def is_type(self, file_types):
         if not isinstance(file_types, list):
             file_types = [file_types]
         return self.file_type in file_types
 
     @staticmethod
-    def prepare(track, offsets, do_splits):
-        keys = []
-        i = 0
-        split = 0
-        normal = 1
-
-        for offset in offsets:
-            i += 1
-            keys.append((
-                i, normal,
-                key_for(TrackFile.prep_file(track, offset, FileType.NORMAL_AUDIO))
-            ))
-
-            if do_splits:
-                keys.append((
-                    i, split,
-                    key_for(TrackFile.prep_file(track, offset, FileType.INSTRUMENTAL_AUDIO))
-                ))
-
-        if track.has_flag(TrackFlags.NOVOX_FIRST):
-            keys = sorted(keys, key=lambda k: (k[1], k[0]))
-        return [k[2] for k in keys]
+    def prepare(track, offsets, file_types):
+        specs = [(offset, file_type) for offset in offsets for file_type in file_types]
+        files = TrackFile.prep_files(track, specs)
+
+        return sorted(files, key=TrackFile.priority)
 
     @staticmethod
     def prep_file(track, offset, file_type):
-        try:
-            track_file = TrackFile.get(
-                TrackFile.track == track,
-                TrackFile.key_offset == offset,
-                TrackFile.file_type == file_type
-            )
-            track_file.set_status(FileStatus.QUEUED)
-            track_file.save()
-            return track_file
-        except TrackFile.DoesNotExist:
-            pass
-
-        track_file = TrackFile(
-            track=track,
-            key_offset=offset,
-            file_type=file_type,
-            status=FileStatus.QUEUED
-        )
+        return TrackFile.prep_files(track, [(offset, file_type)])[0]
+
+    @staticmethod
+    def prep_files(track, specs):
+        files = commit(lambda: TrackFile.upsert(track, specs))
+        publish(track.id, track_version(track))
+        return files
 
-        track_file.save()
-        return track_file
+    @staticmethod
+    def upsert(track, specs):
+        # one upsert puts every (offset, file_type) back to QUEUED, new or not
+        now = datetime.now()
+
+        before = {(f.key_offset, f.file_type): f for f in TrackFile.select().where(TrackFile.track == track)}
+        TrackFile.insert_many([
+            dict(track=track, key_offset=offset, file_type=file_type, status=FileStatus.QUEUED,
+                 created=now, updated=now)
+            for offset, file_type in specs
+        ]).on_conflict(
+            conflict_target=[TrackFile.track, TrackFile.key_offset, TrackFile.file_type],
+            update={TrackFile.status: FileStatus.QUEUED, TrackFile.updated: now}
+        ).execute()
+
+        # re-queueing a file that's still in flight doesn't add to the work left
+        added = [spec for spec in specs if spec not in before or before[spec].is_status(SETTLED_FILE_STATUSES)]
+        Track.update(remaining=Track.remaining + len(added)).where(Track.id == track.id).execute()
+
+        after = {(f.key_offset, f.file_type): f for f in TrackFile.select().where(TrackFile.track == track)}
+        files = [after[spec] for spec in specs]
+        for f in files:
+            f.track = track
+        StatusEvent.insert_many([
+            dict(kind=TrackFile.__name__, object_id=f.id, track_id=track.id, status=status_name(f.status),
+                 previous=status_name(before[spec].status) if spec in before else None,
+                 elapsed=(now - before[spec].updated).total_seconds() if spec in before else 0, at=now)
+            for spec, f in zip(specs, files)
+        ]).execute()
+        return files
 
     def next_status(self):
         status = self._next_status()
@@ -416,6 +495,76 @@ class TrackFile(BaseModel):
         return f'https://s3.amazonaws.com/{S3_BUCKET}/{name}'
 
 
+class StatusEvent(Model):
+    # append-only log of every status change, for stage timings
+    kind = CharField()
+    object_id = IntegerField()
+    track_id = IntegerField(index=True)
+    status = CharField()
+    previous = CharField(null=True)
+    elapsed = FloatField(null=True)
+    at = DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('kind', 'object_id'), False),
+        )
+
+
+def record_status(model, previous):
+    kind = model.__class__.__name__
+    last = StatusEvent.select(StatusEvent.at).where(
+        StatusEvent.kind == kind,
+        StatusEvent.object_id == model.id
+    ).order_by(StatusEvent.id.desc()).first()
+
+    now = datetime.now()
+    since = last.at if last else model.created
+    track_id = model.id if isinstance(model, Track) else model.track_id
+    event = StatusEvent.create(
+        kind=kind,
+        object_id=model.id,
+        track_id=track_id,
+        status=status_name(model.status),
+        previous=status_name(previous) if previous is not None else None,
+        elapsed=(now - since).total_seconds(),
+        at=now
+    )
+    return event
+
+
+def save_status(model, previous):
+    def write():
+        model.save()
+        count_settled(model, previous)
+        return record_status(model, previous)
+
+    event = commit(write)
+    publish(event.track_id, event.id)
+
+
+def count_settled(model, previous):
+    # runs in the status write's transaction, so the count can't drift from the statuses
+    if not isinstance(model, TrackFile):
+        return
+
+    if previous not in SETTLED_FILE_STATUSES and model.status in SETTLED_FILE_STATUSES:
+        Track.update(remaining=Track.remaining - 1).where(Track.id == model.track_id).execute()
+
+
+def commit(write):
+    # status writes are small and frequent, concurrent ones share a transaction
+    if DB_GROUP_COMMIT:
+        return group_commit.run(write)
+    return write()
+
+
+def track_version(track: Track):
+    # bumped by every status change of the track or any of its files
+    return StatusEvent.select(fn.MAX(StatusEvent.id)).where(StatusEvent.track_id == track.id).scalar() or 0
+
+
 def files_for(track: Track):
     files = [t for t in TrackFile.select().where(TrackFile.track == track).order_by(TrackFile.key_offset)]
     return files
@@ -423,39 +572,132 @@ def files_for(track: Track):
 
 def files_data_for(track: Track):
     files = files_for(track)
+    for track_file in files:
+        track_file.track = track
     return [track_file.serial() for track_file in files]
 
 
+def queue_rekey(track, files, red):
+    if REKEY_BATCH:
+        return red.rpush(Queue.REKEY_BATCH.value, key_for(track))
+
+    if files:
+        job_queue(red, Queue.REKEY.value).push([key_for(f) for f in files], user=track.user_id, track=track.id,
+                                               priorities=[f.priority() for f in files])
+
+
+def request_render(track, offset, red):
+    # reopens a lazy track for one more key. asking for a key that is already queued or done queues nothing,
+    # and the write lock orders this against cleanup_check, so a track never cleans up under a new file
+    types = track.file_types()
+
+    def write():
+        with db.atomic('IMMEDIATE'):
+            previous = Track.get_by_id(track.id).status
+            if previous not in [TrackStatus.DONE, TrackStatus.NEEDS_REKEY, TrackStatus.REKEYING]:
+                return None
+
+            # evict_sources removes them under the same lock, so a render is never queued without them
+            if not track.has_sources():
+                raise JobError(f'The sources of {track} have been removed, submit the song again for more keys')
+
+            existing = TrackFile.select().where(
+                TrackFile.track == track,
+                TrackFile.key_offset == offset,
+                TrackFile.status != FileStatus.ERROR
+            )
+            specs = [(offset, t) for t in set(types) - {f.file_type for f in existing}]
+            if not specs:
+                return []
+
+            track.status = TrackStatus.REKEYING
+            if previous != TrackStatus.REKEYING:
+                Track.update(status=TrackStatus.REKEYING, updated=datetime.now()).where(Track.id == track.id).execute()
+                record_status(track, previous)
+            return TrackFile.upsert(track, sorted(specs, key=lambda spec: spec[1].value))
+
+    files = commit(write)
+    if files:
+        publish(track.id, track_version(track))
+        queue_rekey(track, files, red)
+    return files
+
+
 def queue_encode(track_file, audio, red):
     track_file.set_status(FileStatus.NEEDS_ENCODING)
+    if ENCODE_BATCH:
+        red.hset(pending_key(Queue.ENCODE, track_file.track_id), track_file.id, audio)
     red.rpush(Queue.ENCODE.value, key_for(track_file, audio))
 
 
 def queue_upload(track_file, audio, red):
     track_file.set_status(FileStatus.NEEDS_UPLOAD)
+    if UPLOAD_BATCH:
+        red.hset(pending_key(Queue.UPLOAD, track_file.track_id), track_file.id, audio)
     red.rpush(Queue.UPLOAD.value, key_for(track_file, audio))
 
 
-def queue_cleanup(track, red):
-    track.set_status(TrackStatus.NEEDS_CLEANUP)
-    red.rpush(Queue.CLEANUP.value, key_for(track))
+def pending_key(queue, track_id):
+    return make_key(queue.value, 'pending', track_id)
+
+
+def claim(track_file, from_statuses, status):
+    # conditional update, so only one worker moves a file out of from_statuses
+    previous = track_file.status
+
+    def write():
+        claimed = TrackFile.update(status=status, updated=datetime.now()).where(
+            TrackFile.id == track_file.id,
+            TrackFile.status.in_(from_statuses)
+        ).execute()
+
+        if not claimed:
+            return None
+        track_file.status = status
+        count_settled(track_file, previous)
+        return record_status(track_file, previous)
+
+    event = commit(write)
+    if event:
+        publish(event.track_id, event.id)
+    return bool(event)
+
+
+def claim_pending(queue, track, from_statuses, status, red):
+    key = pending_key(queue, track.id)
+    claimed = []
+    for file_id, path in red.hgetall(key).items():
+        track_file = TrackFile.get_or_none(TrackFile.id == int(file_id))
+        if track_file and claim(track_file, from_statuses, status):
+            claimed.append((track_file, path.decode('utf-8')))
+        red.hdel(key, file_id)
+
+    return claimed
 
 
 def cleanup_check(track, red):
-    tracks = TrackFile.select().where(
-        TrackFile.track == track
-    )
+    # only one caller's conditional update can move the track on, and only with no files left
+    previous = track.status
 
-    tracks = [t for t in tracks]
-    kept = [t for t in tracks if not t.is_status([FileStatus.DONE, FileStatus.ERROR])]
-    track_count = len(kept)
+    def write():
+        ready = Track.update(status=TrackStatus.NEEDS_CLEANUP, updated=datetime.now()).where(
+            Track.id == track.id,
+            Track.status == previous,
+            Track.remaining <= 0
+        ).execute()
 
-    if track_count == 0:
-        queue_cleanup(track, red)
+        if not ready:
+            return None
+        track.status = TrackStatus.NEEDS_CLEANUP
+        return record_status(track, previous)
+
+    event = commit(write)
+    if event:
+        publish(event.track_id, event.id)
+        red.rpush(Queue.CLEANUP.value, key_for(track))
 
 
 if mktables:
     logger.info("making tables")
-    db.connect()
-    db.create_tables([User, Track, TrackFile], safe=True)
-    db.close()
+
+migrate(db, [User, Track, TrackFile, StatusEvent])
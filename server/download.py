@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 import os
 
-from server.consts import YTDLP_OUTPUT_DIR, YTDLP_IMAGE, DOCKER_USER
+from server.audio import write_pcm
+from server.consts import YTDLP_OUTPUT_DIR, YTDLP_IMAGE, DOCKER_USER, PCM_STORE
 from server.db import Queue, Track, TrackStatus
 from server.errs import JobError
 from server.log import logger
@@ -25,13 +26,16 @@ class DownloadTask(Task):
         ]
 
         logger.info("command: %s", command)
-        self.docker.containers.run(YTDLP_IMAGE, command=command, remove=True, volumes=volumes, user=DOCKER_USER)
+        self.run_container(YTDLP_IMAGE, command, volumes, user=DOCKER_USER)
 
         outfile = os.path.join(YTDLP_OUTPUT_DIR, '{}.wav'.format(model.id))
 
         if not os.path.isfile(outfile):
             raise JobError('file not found: {}'.format(outfile))
 
+        if PCM_STORE:
+            write_pcm(outfile)
+
         model.next_status(self.redis)
 
 
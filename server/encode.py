@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from ffmpeg import FFmpeg
-from mutagen.easyid3 import EasyID3
 
-from server.db import TrackFile, Queue, FileStatus, queue_upload
+from server.consts import ENCODE_BATCH, ENCODE_BATCH_THREADS
+from server.db import TrackFile, Queue, FileStatus, queue_upload, claim, claim_pending
 from server.log import logger
 from server.task import Task
 from server.util import assert_file
@@ -15,33 +16,53 @@ class EncodeTask(Task):
         super(EncodeTask, self).__init__(Queue.ENCODE.value, TrackFile)
 
     def work(self, track_file: TrackFile, opts):
+        audio = opts.pop(0)
+        if ENCODE_BATCH:
+            return self.encode_batch(track_file, audio)
+
         # track_file.expect_status([FileStatus.NEEDS_ENCODING, FileStatus.ENCODING])
         track_file.set_status(FileStatus.ENCODING)
-        audio = opts.pop(0)
+        outfile = self.encode(track_file, audio)
+        queue_upload(track_file, outfile, self.redis)
+
+    def encode_batch(self, track_file, audio):
+        # take every wav of the track that is ready; their own jobs will find nothing left to do
+        encodes = claim_pending(Queue.ENCODE, track_file.track, [FileStatus.NEEDS_ENCODING], FileStatus.ENCODING,
+                                self.redis)
+        if claim(track_file, [FileStatus.NEEDS_ENCODING], FileStatus.ENCODING):
+            encodes.append((track_file, audio))
+
+        if not encodes:
+            return
+
+        logger.info("encoding %s files for %s", len(encodes), track_file.track)
+        with ThreadPoolExecutor(max_workers=min(ENCODE_BATCH_THREADS, len(encodes))) as pool:
+            futures = {pool.submit(self.encode, encode, path): encode for encode, path in encodes}
+            for future in as_completed(futures):
+                encode = futures[future]
+                try:
+                    queue_upload(encode, future.result(), self.redis)
+                except Exception as e:
+                    logger.exception(e)
+                    encode.error_message = str(e)
+                    encode.set_status(encode.error_status)
+
+    def encode(self, track_file, audio):
         dir = os.path.dirname(audio)
         outfile = os.path.join(dir, track_file.nice_name())
+        title = f"{track_file.nice_key()} - {track_file.track.title}"
 
         logger.info(f"ffmpeg -y -i {audio} {outfile}")
         ffmpeg = (
             FFmpeg()
             .option("y")
             .input(audio)
-            .output(outfile)
+            .output(outfile, metadata=f"title={title}")
         )
 
         ffmpeg.execute()
         assert_file(outfile)
-
-        try:
-            tags = EasyID3(outfile)
-            nice_key = track_file.nice_key()
-            tags["title"] = f"{nice_key} - {track_file.track.title}"
-            tags.save()
-        except Exception as e:
-            logger.exception(e)
-            pass
-
-        queue_upload(track_file, outfile, self.redis)
+        return outfile
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+import json
+import time
+from contextlib import contextmanager
+from threading import Thread, Lock, Event
+
+from redis import RedisError
+from redis.client import StrictRedis
+
+from server.consts import REDIS_HOST, EVENTS_CHANNEL
+from server.log import logger
+
+_publisher = None
+
+
+def publish(track_id, version):
+    global _publisher
+    if _publisher is None:
+        _publisher = StrictRedis(host=REDIS_HOST)
+
+    try:
+        _publisher.publish(EVENTS_CHANNEL, json.dumps(dict(track=track_id, version=version)))
+    except RedisError as e:
+        # listeners fall back to polling, a lost event shouldn't fail the job
+        logger.warning("Could not publish event for track %s: %s", track_id, e)
+
+
+class Mailbox:
+    # the set of tracks changed since the client last looked, so bursts coalesce
+    def __init__(self):
+        self.changed = set()
+        self.lock = Lock()
+        self.ready = Event()
+
+    def put(self, track_id):
+        with self.lock:
+            self.changed.add(track_id)
+            self.ready.set()
+
+    def take(self, timeout):
+        if not self.ready.wait(timeout):
+            return set()
+
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            self.ready.clear()
+        return changed
+
+
+class Broker:
+    # one redis subscription per process, fanned out to every listening client
+    def __init__(self, red):
+        self.red = red
+        self.listeners = {}
+        self.lock = Lock()
+        self.thread = None
+
+    @contextmanager
+    def listening(self, track_id=None):
+        # None listens to every track
+        mailbox = Mailbox()
+        with self.lock:
+            self.listeners.setdefault(track_id, set()).add(mailbox)
+            if not self.thread:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+        try:
+            yield mailbox
+        finally:
+            with self.lock:
+                self.listeners[track_id].discard(mailbox)
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.red.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(EVENTS_CHANNEL)
+                for message in pubsub.listen():
+                    self.notify(json.loads(message['data'])['track'])
+            except RedisError as e:
+                logger.warning("Event subscription lost: %s", e)
+                time.sleep(1)
+
+    def notify(self, track_id):
+        with self.lock:
+            mailboxes = list(self.listeners.get(track_id, ())) + list(self.listeners.get(None, ()))
+
+        for mailbox in mailboxes:
+            mailbox.put(track_id)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+import json
+import os
+
+from yt_dlp import YoutubeDL
+
+from server.audio import write_pcm
+from server.consts import YTDLP_OUTPUT_DIR, PCM_STORE
+from server.db import Queue, Track, TrackStatus
+from server.errs import JobError
+from server.log import logger
+from server.metadata import apply_info
+from server.task import Task
+
+
+class FetchTask(Task):
+    # metadata and download in one pass: the url is resolved once, in-process, and its audio is only
+    # fetched once the track has passed the length check
+    def __init__(self):
+        super(FetchTask, self).__init__(Queue.METADATA.value, Track)
+
+    def work(self, model: Track, opts):
+        model.set_status(TrackStatus.GETTING_METADATA)
+
+        base = os.path.join(YTDLP_OUTPUT_DIR, str(model.id))
+        with YoutubeDL(ytdl_options(base)) as ydl:
+            info = ydl.extract_info(model.url, download=False)
+            with open(f'{base}.info.json', 'w') as f:
+                json.dump(ydl.sanitize_info(info), f)
+
+            if not apply_info(model, info, self.redis):
+                return
+
+            # the download stage is entered and left within this job
+            model.set_status(TrackStatus.NEEDS_DOWNLOAD)
+            model.set_status(TrackStatus.DOWNLOADING)
+            ydl.process_ie_result(info, download=True)
+
+        outfile = f'{base}.wav'
+        if not os.path.isfile(outfile):
+            raise JobError('file not found: {}'.format(outfile))
+
+        if PCM_STORE:
+            write_pcm(outfile)
+
+        model.next_status(self.redis)
+
+
+def ytdl_options(base):
+    # the same as the download container's `-x --audio-format wav --audio-quality 0`
+    return dict(
+        outtmpl=f'{base}.%(ext)s',
+        format='bestaudio/best',
+        noplaylist=True,
+        quiet=True,
+        logger=logger,
+        postprocessors=[dict(key='FFmpegExtractAudio', preferredcodec='wav', preferredquality='0')],
+    )
+
+
+if __name__ == '__main__':
+    FetchTask().watch()
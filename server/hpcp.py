@@ -0,0 +1,169 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from server.audio import read_audio, to_float
+
+# mirrors key-detect/index.py: blackmanharris92 frames -> spectral peaks -> hpcp -> edma key profile,
+# computed with numpy over blocks of frames instead of one essentia call per frame
+FRAME_SIZE = 2048
+HOP_SIZE = 1024
+BLOCK_FRAMES = 4096
+
+# progressive mode, as in key-detect/index.py
+DECIMATION = 4
+SEGMENT_SECONDS = 8
+MAX_SEGMENTS = 24
+STABLE_SEGMENTS = 3
+
+REFERENCE_FREQUENCY = 440.0
+MIN_FREQUENCY = 40.0
+MAX_FREQUENCY = 5000.0
+BAND_SPLIT_FREQUENCY = 500.0
+
+KEYS = ['A', 'Bb', 'B', 'C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab']
+
+EDMA_MAJOR = np.array([
+    0.16519551, 0.04749026, 0.08293076, 0.06687112, 0.09994645, 0.09274123,
+    0.05294487, 0.13159476, 0.05218986, 0.07443653, 0.06940723, 0.06425150,
+])
+EDMA_MINOR = np.array([
+    0.17235348, 0.04000000, 0.07610090, 0.12708875, 0.05274718, 0.08595104,
+    0.05315434, 0.12693139, 0.09245521, 0.05002441, 0.06657573, 0.05271125,
+])
+
+
+def blackmanharris92(size):
+    n = np.arange(size) * 2 * np.pi / (size - 1)
+    return (0.35875 - 0.48829 * np.cos(n) + 0.14128 * np.cos(2 * n) - 0.01168 * np.cos(3 * n)).astype(np.float32)
+
+
+WINDOW = blackmanharris92(FRAME_SIZE)
+
+
+def lowpass(taps=63):
+    # hamming windowed sinc, cut off a little under the decimated nyquist
+    cutoff = 0.45 / DECIMATION
+    n = np.arange(taps) - taps // 2
+    h = np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (h / h.sum()).astype(np.float32)
+
+
+LOWPASS = lowpass()
+
+
+def load_mono(path):
+    samples, rate = read_audio(path)
+    return to_float(samples).mean(axis=1), rate
+
+
+def frame_hpcps(mono, rate):
+    frames = sliding_window_view(mono, FRAME_SIZE)[::HOP_SIZE]
+    blocks = [hpcp_block(frames[i:i + BLOCK_FRAMES], rate) for i in range(0, len(frames), BLOCK_FRAMES)]
+    if not blocks:
+        return np.zeros((0, 12))
+    return np.concatenate(blocks)
+
+
+def hpcp_block(frames, rate):
+    magnitudes = np.abs(np.fft.rfft(frames * WINDOW, axis=1))
+    # nothing above MAX_FREQUENCY reaches the hpcp, so don't look for peaks there
+    magnitudes = magnitudes[:, :int(MAX_FREQUENCY * FRAME_SIZE / rate) + 2]
+    frequencies, peaks = spectral_peaks(magnitudes, rate)
+
+    low = hpcp(frequencies, peaks, MIN_FREQUENCY, BAND_SPLIT_FREQUENCY)
+    high = hpcp(frequencies, peaks, BAND_SPLIT_FREQUENCY, MAX_FREQUENCY)
+    return unit_max(unit_max(low) + unit_max(high))
+
+
+def spectral_peaks(magnitudes, rate):
+    # local maxima with parabolic interpolation, as (frames, bins) arrays that are zero off-peak
+    left, centre, right = magnitudes[:, :-2], magnitudes[:, 1:-1], magnitudes[:, 2:]
+    is_peak = (centre > left) & (centre >= right) & (centre > 0)
+
+    curvature = left - 2 * centre + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(curvature != 0, 0.5 * (left - right) / curvature, 0)
+
+    bins = np.arange(1, magnitudes.shape[1] - 1) + shift
+    frequencies = bins * rate / FRAME_SIZE
+    peaks = np.where(is_peak, centre - 0.25 * (left - right) * shift, 0)
+    return frequencies, peaks
+
+
+def hpcp(frequencies, peaks, min_frequency, max_frequency):
+    # squared-cosine weighting over a one-semitone window, summing squared magnitudes
+    in_band = (frequencies >= min_frequency) & (frequencies < max_frequency) & (peaks > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        position = np.where(in_band, 12 * np.log2(frequencies / REFERENCE_FREQUENCY), 0) % 12
+
+    energy = np.where(in_band, peaks ** 2, 0)
+    distance = position[..., None] - np.arange(12)
+    distance = np.abs((distance + 6) % 12 - 6)
+    weight = np.where(distance <= 0.5, np.cos(np.pi * distance) ** 2, 0)
+    return np.einsum('fp,fpk->fk', energy, weight)
+
+
+def unit_max(pcps):
+    peak = pcps.max(axis=1, keepdims=True)
+    return np.divide(pcps, peak, out=np.zeros_like(pcps), where=peak > 0)
+
+
+def estimate_key(pcp):
+    # pearson correlation against every rotation of both profiles
+    candidates = []
+    for scale, profile in [('major', EDMA_MAJOR), ('minor', EDMA_MINOR)]:
+        for i, key in enumerate(KEYS):
+            rotated = np.roll(profile, i)
+            candidates.append((np.corrcoef(pcp, rotated)[0, 1], key, scale))
+
+    candidates = sorted(candidates, key=lambda c: np.nan_to_num(c[0], nan=-1), reverse=True)
+    strength, key, scale = candidates[0]
+    second = candidates[1][0]
+    relative = (strength - second) / strength if strength > 0 else 0
+    return key, scale, float(np.nan_to_num(strength)), float(np.nan_to_num(relative))
+
+
+def detect_key(path):
+    mono, rate = load_mono(path)
+    pcps = frame_hpcps(mono, rate)
+    if not len(pcps):
+        return estimate_key(np.zeros(12))
+    return estimate_key(pcps.mean(axis=0))
+
+
+def detect_key_progressive(path, min_strength):
+    # segments spread over the song at a quarter of the rate, until the estimate has held for STABLE_SEGMENTS
+    # segments at min_strength or better. only the segments read are ever decoded
+    samples, rate = read_audio(path)
+    segment = SEGMENT_SECONDS * rate
+    if len(samples) < segment * STABLE_SEGMENTS * 2:
+        return detect_key(path)
+
+    total, frames, estimates = np.zeros(12), 0, []
+    for start in segment_starts(len(samples), segment):
+        mono = to_float(samples[start:start + segment]).mean(axis=1)
+        pcps = frame_hpcps(np.convolve(mono, LOWPASS, 'same')[::DECIMATION], rate / DECIMATION)
+        total += pcps.sum(axis=0)
+        frames += len(pcps)
+        if not frames:
+            continue
+
+        estimates.append(estimate_key(total / frames))
+        recent = estimates[-STABLE_SEGMENTS:]
+        if len(recent) == STABLE_SEGMENTS and len({e[:2] for e in recent}) == 1 and \
+                all(e[2] >= min_strength for e in recent):
+            return estimates[-1]
+
+    # never settled, so it gets the whole song
+    return detect_key(path)
+
+
+def segment_starts(length, segment):
+    # van der corput order: each new segment lands in the largest gap left, so early ones cover the whole song
+    for n in range(1, MAX_SEGMENTS + 1):
+        position, denominator = 0.0, 1
+        while n:
+            denominator *= 2
+            n, remainder = divmod(n, 2)
+            position += remainder / denominator
+        yield int(position * (length - segment))
@@ -0,0 +1,253 @@
+import os
+import socket
+import time
+from uuid import uuid4
+
+from server.consts import QUEUE_BLOCK_TIMEOUT, QUEUE_LEASE_SECONDS, FAIR_QUEUES, FAIR_MAX_WAIT
+from server.util import make_key
+
+_boots = {}
+
+
+def worker_name():
+    # a restarted container has the same hostname and usually pid 1, so each process start gets its own suffix.
+    # otherwise the new process would renew the old one's lease and its in-flight jobs would never be requeued
+    pid = os.getpid()
+    if pid not in _boots:
+        _boots[pid] = uuid4().hex[:8]
+    return f'{socket.gethostname()}-{pid}-{_boots[pid]}'
+
+
+class JobQueue:
+    # keys are moved atomically into a per-worker in-flight list until acked. a worker
+    # keeps its lease fresh while alive; once it lapses, reap() requeues its in-flight keys.
+    def __init__(self, red, name, worker=None):
+        self.red = red
+        self.name = name
+        self.worker = worker or worker_name()
+        self.workers = make_key(name, 'workers')
+        self.inflight = self.inflight_for(self.worker)
+        self.lease = self.lease_for(self.worker)
+
+    def inflight_for(self, worker):
+        return make_key(self.name, 'inflight', worker)
+
+    def lease_for(self, worker):
+        return make_key(self.name, 'lease', worker)
+
+    def pop(self, timeout=QUEUE_BLOCK_TIMEOUT):
+        key = self.red.blmove(self.name, self.inflight, timeout, 'LEFT', 'RIGHT')
+        if not key:
+            return None
+        return key.decode('utf-8')
+
+    def push(self, keys, user=0, track=0, priorities=None):
+        return self.red.rpush(self.name, *keys)
+
+    def ack(self, key):
+        self.red.lrem(self.inflight, 1, key)
+
+    def depth(self):
+        return self.red.llen(self.name)
+
+    def renew(self):
+        self.red.set(self.lease, self.worker, ex=QUEUE_LEASE_SECONDS)
+        self.red.sadd(self.workers, self.worker)
+
+    def inflight_count(self):
+        return sum(self.red.llen(self.inflight_for(w.decode('utf-8'))) for w in self.red.smembers(self.workers))
+
+    def reap(self):
+        requeued = 0
+        for worker in self.red.smembers(self.workers):
+            worker = worker.decode('utf-8')
+            if self.red.exists(self.lease_for(worker)):
+                continue
+
+            requeued += self.requeue(self.inflight_for(worker))
+            self.red.srem(self.workers, worker)
+
+        return requeued
+
+    def requeue(self, inflight):
+        requeued = 0
+        while self.red.lmove(inflight, self.name, 'RIGHT', 'LEFT'):
+            requeued += 1
+        return requeued
+
+
+# a job's meta is 'user|track|priority|enqueued at'; users and tracks are rings of the ones with work waiting
+ENQUEUE = '''
+local function enqueue(prefix, job, meta)
+    local user, track, priority, at = string.match(meta, '^([^|]*)|([^|]*)|([^|]*)|([^|]*)$')
+    local users = prefix .. ':users'
+    local tracks = prefix .. ':user:' .. user
+    redis.call('ZADD', prefix .. ':track:' .. track, priority, job)
+    redis.call('ZADD', prefix .. ':age', at, job)
+    if not redis.call('LPOS', tracks, track) then
+        redis.call('RPUSH', tracks, track)
+    end
+    if not redis.call('LPOS', users, user) then
+        redis.call('RPUSH', users, user)
+    end
+end
+
+local function wake(prefix, count)
+    if count > 0 then
+        local tokens = {}
+        for i = 1, math.min(count, 64) do
+            tokens[i] = 1
+        end
+        redis.call('RPUSH', prefix .. ':wake', unpack(tokens))
+        redis.call('LTRIM', prefix .. ':wake', 0, 63)
+    end
+end
+'''
+
+PUSH = ENQUEUE + '''
+local prefix = ARGV[1]
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', prefix .. ':meta', ARGV[i], ARGV[i + 1])
+    enqueue(prefix, ARGV[i], ARGV[i + 1])
+end
+wake(prefix, (#ARGV - 1) / 2)
+return (#ARGV - 1) / 2
+'''
+
+REQUEUE = ENQUEUE + '''
+local prefix, inflight, name = ARGV[1], ARGV[2], ARGV[3]
+local requeued = 0
+while true do
+    local job = redis.call('RPOP', inflight)
+    if not job then
+        break
+    end
+    local meta = redis.call('HGET', prefix .. ':meta', job)
+    if meta then
+        enqueue(prefix, job, meta)
+    else
+        redis.call('LPUSH', name, job)
+    end
+    requeued = requeued + 1
+end
+wake(prefix, requeued)
+return requeued
+'''
+
+POP = '''
+local prefix, inflight, now, max_wait, name = ARGV[1], ARGV[2], tonumber(ARGV[3]), tonumber(ARGV[4]), ARGV[5]
+local users = prefix .. ':users'
+local job, track
+
+-- anything that has waited too long goes first, whoever it belongs to
+local oldest = redis.call('ZRANGE', prefix .. ':age', 0, 0, 'WITHSCORES')
+if oldest[1] and now - tonumber(oldest[2]) > max_wait then
+    job = oldest[1]
+else
+    local user = redis.call('LMOVE', users, users, 'LEFT', 'RIGHT')
+    if not user then
+        -- jobs pushed before the queue was fair, or requeued without their meta
+        return redis.call('LMOVE', name, inflight, 'LEFT', 'RIGHT')
+    end
+    local tracks = prefix .. ':user:' .. user
+    track = redis.call('LMOVE', tracks, tracks, 'LEFT', 'RIGHT')
+    if track then
+        job = redis.call('ZRANGE', prefix .. ':track:' .. track, 0, 0)[1]
+    end
+    if not job then
+        if track then
+            redis.call('LREM', tracks, 0, track)
+        end
+        if redis.call('LLEN', tracks) == 0 then
+            redis.call('LREM', users, 0, user)
+        end
+        return false
+    end
+end
+
+local meta = redis.call('HGET', prefix .. ':meta', job)
+if not meta then
+    -- an ack used to drop the meta of a copy pushed again while in flight; hand the job out rather than keep
+    -- failing on it. a copy left in a track's set is picked up (and dropped) from there in turn
+    redis.call('ZREM', prefix .. ':age', job)
+    if track then
+        redis.call('ZREM', prefix .. ':track:' .. track, job)
+    end
+    redis.call('RPUSH', inflight, job)
+    return job
+end
+
+local user
+user, track = string.match(meta, '^([^|]*)|([^|]*)|')
+local queued = prefix .. ':track:' .. track
+redis.call('ZREM', queued, job)
+redis.call('ZREM', prefix .. ':age', job)
+if redis.call('ZCARD', queued) == 0 then
+    local tracks = prefix .. ':user:' .. user
+    redis.call('LREM', tracks, 0, track)
+    if redis.call('LLEN', tracks) == 0 then
+        redis.call('LREM', users, 0, user)
+    end
+end
+redis.call('RPUSH', inflight, job)
+return job
+'''
+
+ACK = '''
+local prefix, inflight, job = ARGV[1], ARGV[2], ARGV[3]
+redis.call('LREM', inflight, 1, job)
+-- the same key may have been pushed again while this copy was in flight, its meta is the queued copy's now
+if not redis.call('ZSCORE', prefix .. ':age', job) then
+    redis.call('HDEL', prefix .. ':meta', job)
+end
+'''
+
+
+class FairJobQueue(JobQueue):
+    # jobs wait in a sorted set per track, lowest priority first. pops go round robin over users, then
+    # over each user's tracks, so one big batch can't hold up everyone else. a job older than
+    # FAIR_MAX_WAIT seconds goes ahead of all of them.
+    def __init__(self, red, name, worker=None):
+        super(FairJobQueue, self).__init__(red, name, worker)
+        self.prefix = make_key(name, 'fair')
+        self.meta = make_key(self.prefix, 'meta')
+        self.age = make_key(self.prefix, 'age')
+        self.wake = make_key(self.prefix, 'wake')
+        self.push_script = red.register_script(PUSH)
+        self.pop_script = red.register_script(POP)
+        self.requeue_script = red.register_script(REQUEUE)
+        self.ack_script = red.register_script(ACK)
+
+    def push(self, keys, user=0, track=0, priorities=None):
+        now = time.time()
+        priorities = priorities or [0] * len(keys)
+        args = [self.prefix]
+        for key, priority in zip(keys, priorities):
+            args += [key, f'{user}|{track}|{priority}|{now}']
+        return self.push_script(args=args)
+
+    def pop(self, timeout=QUEUE_BLOCK_TIMEOUT):
+        key = self.take()
+        if key is None and self.red.blpop(self.wake, timeout):
+            key = self.take()
+        if not key:
+            return None
+        return key.decode('utf-8')
+
+    def take(self):
+        return self.pop_script(args=[self.prefix, self.inflight, time.time(), FAIR_MAX_WAIT, self.name])
+
+    def ack(self, key):
+        self.ack_script(args=[self.prefix, self.inflight, key])
+
+    def depth(self):
+        return self.red.zcard(self.age) + self.red.llen(self.name)
+
+    def requeue(self, inflight):
+        return self.requeue_script(args=[self.prefix, inflight, self.name])
+
+
+def job_queue(red, name, worker=None):
+    if name in FAIR_QUEUES:
+        return FairJobQueue(red, name, worker)
+    return JobQueue(red, name, worker)
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 import os
 
-from server.consts import KEYDETECT_IMAGE, KEYDETECT_INPUT_DIR, KEYDETECT_OUTPUT_DIR, ORIGINAL_KEY, DOCKER_USER
+from server.consts import KEYDETECT_IMAGE, KEYDETECT_INPUT_DIR, KEYDETECT_OUTPUT_DIR, ORIGINAL_KEY, DOCKER_USER, \
+    KEYDETECT_ENGINE, KEYDETECT_MODE, KEYDETECT_MIN_STRENGTH
 from server.db import Queue, Track, TrackStatus, queue_encode, TrackFile, FileType
+from server.hpcp import detect_key, detect_key_progressive
 from server.log import logger
 from server.task import Task, volume, read_json
 from server.util import fix_key, assert_file
@@ -18,26 +20,21 @@ class KeyTask(Task):
 
         logger.info("Starting key-detect: %s", model.title)
 
-        input_dir = "/input"
-        output_dir = "/output"
-
-        volumes = [
-            volume(KEYDETECT_INPUT_DIR, input_dir),
-            volume(KEYDETECT_OUTPUT_DIR, output_dir),
-        ]
-
         in_file = os.path.join(KEYDETECT_INPUT_DIR, f'{model.id}.wav')
         assert_file(in_file)
 
-        command = f"{input_dir}/{model.id}.wav {output_dir}/{model.id}.key.json"
-        logger.info("command: %s", command)
-        self.docker.containers.run(KEYDETECT_IMAGE, command=command, remove=True, volumes=volumes, user=DOCKER_USER)
-
-        outfile = os.path.join(KEYDETECT_OUTPUT_DIR, '{}.key.json'.format(model.id))
+        if KEYDETECT_ENGINE == 'numpy':
+            if KEYDETECT_MODE == 'progressive':
+                key, scale, strength, _ = detect_key_progressive(in_file, KEYDETECT_MIN_STRENGTH)
+            else:
+                key, scale, strength, _ = detect_key(in_file)
+            data = dict(key=key, scale=scale, strength=strength)
+        else:
+            data = self.detect(model)
 
-        data = read_json(outfile)
         model.key = fix_key(data.get('key'))
         model.quality = data.get('scale')
+        model.key_strength = data.get('strength')
         model.save()
 
         track_file = TrackFile.prep_file(model, ORIGINAL_KEY, FileType.NORMAL_AUDIO)
@@ -45,6 +42,23 @@ class KeyTask(Task):
 
         model.next_status(self.redis)
 
+    def detect(self, model):
+        input_dir = "/input"
+        output_dir = "/output"
+
+        volumes = [
+            volume(KEYDETECT_INPUT_DIR, input_dir),
+            volume(KEYDETECT_OUTPUT_DIR, output_dir),
+        ]
+
+        command = f"{input_dir}/{model.id}.wav {output_dir}/{model.id}.key.json"
+        logger.info("command: %s", command)
+        environment = dict(KEYDETECT_MODE=KEYDETECT_MODE, KEYDETECT_MIN_STRENGTH=KEYDETECT_MIN_STRENGTH)
+        self.run_container(KEYDETECT_IMAGE, command, volumes, user=DOCKER_USER, environment=environment)
+
+        outfile = os.path.join(KEYDETECT_OUTPUT_DIR, '{}.key.json'.format(model.id))
+        return read_json(outfile)
+
 
 if __name__ == '__main__':
     KeyTask().watch()
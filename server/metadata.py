@@ -4,11 +4,14 @@ from pathlib import Path
 
 from urllib3.util import parse_url
 
+from server.cache import settle
 from server.consts import YTDLP_OUTPUT_DIR, YTDLP_IMAGE, DOCKER_USER
 from server.db import Queue, Track, TrackStatus
 from server.log import logger
 from server.task import Task, volume, read_json
 
+MAX_DURATION = 15 * 60
+
 
 class MetadataTask(Task):
     def __init__(self):
@@ -26,22 +29,30 @@ class MetadataTask(Task):
         ]
 
         logger.info("command: %s", command)
-        self.docker.containers.run(YTDLP_IMAGE, command=command, remove=True, volumes=volumes, user=DOCKER_USER)
+        self.run_container(YTDLP_IMAGE, command, volumes, user=DOCKER_USER)
 
         outfile = os.path.join(YTDLP_OUTPUT_DIR, '{}.info.json'.format(model.id))
 
         data = read_json(outfile)
-        model.title = data.get('title')
-        model.thumbnail = get_thumb(data.get("thumbnails"))
-        model.duration = data.get('duration_string', 'unknown')
-        model.save()
-
-        if data.get('duration', 0) >= 15 * 60:
-            model.set_status(TrackStatus.REJECTED)
-        else:
+        if apply_info(model, data, self.redis):
             model.next_status(self.redis)
 
 
+def apply_info(model, data, red):
+    # False if the track was rejected for its length
+    model.title = data.get('title')
+    model.thumbnail = get_thumb(data.get("thumbnails") or [])
+    model.duration = data.get('duration_string', 'unknown')
+    model.save()
+
+    if (data.get('duration') or 0) >= MAX_DURATION:
+        model.set_status(TrackStatus.REJECTED)
+        settle(model, red)
+        return False
+
+    return True
+
+
 def get_thumb(thumbs):
     return _get_thumb(thumbs, 180, 320, '.jpg') or \
            _get_thumb(thumbs, 188, 336, '.jpg') or \
@@ -0,0 +1,133 @@
+from threading import Lock
+
+from peewee import fn, Case
+
+from server.db import Queue, StatusEvent, Track, TrackFile, status_name
+from server.jobs import job_queue
+
+BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+
+
+def render_metrics(red):
+    totals.update()
+    lines = []
+    lines += stage_histograms()
+    lines += status_counters()
+    lines += status_gauges()
+    lines += queue_gauges(red)
+    return '\n'.join(lines) + '\n'
+
+
+class StatusTotals:
+    # running totals of the status log. each scrape only aggregates the events written since the last one, rowids
+    # are handed out under sqlite's write lock so everything below the newest id seen is already committed
+    def __init__(self):
+        self.lock = Lock()
+        self.last_id = 0
+        self.stages = {}
+        self.statuses = {}
+
+    def update(self):
+        with self.lock:
+            newest = StatusEvent.select(fn.MAX(StatusEvent.id)).scalar() or 0
+            if newest <= self.last_id:
+                return
+
+            new = (StatusEvent.id > self.last_id) & (StatusEvent.id <= newest)
+            self.add_stages(new)
+            self.add_statuses(new)
+            self.last_id = newest
+
+    def add_stages(self, new):
+        elapsed = StatusEvent.elapsed
+        columns = [fn.SUM(Case(None, [(elapsed <= b, 1)], 0)).alias(f'le{i}') for i, b in enumerate(BUCKETS)]
+        rows = (StatusEvent
+                .select(StatusEvent.kind, StatusEvent.previous, fn.COUNT(StatusEvent.id).alias('count'),
+                        fn.SUM(elapsed).alias('total'), *columns)
+                .where(new, StatusEvent.previous.is_null(False))
+                .group_by(StatusEvent.kind, StatusEvent.previous)
+                .dicts())
+
+        for row in rows:
+            totals = self.stages.setdefault((row['kind'], row['previous']), [0, 0.0] + [0] * len(BUCKETS))
+            totals[0] += row['count']
+            totals[1] += row['total'] or 0
+            for i in range(len(BUCKETS)):
+                totals[2 + i] += row[f'le{i}']
+
+    def add_statuses(self, new):
+        rows = (StatusEvent
+                .select(StatusEvent.kind, StatusEvent.status, fn.COUNT(StatusEvent.id).alias('count'))
+                .where(new)
+                .group_by(StatusEvent.kind, StatusEvent.status)
+                .dicts())
+        for row in rows:
+            key = (row['kind'], row['status'])
+            self.statuses[key] = self.statuses.get(key, 0) + row['count']
+
+
+totals = StatusTotals()
+
+
+def stage_histograms():
+    # time spent in each status: NEEDS_* is queue wait, *ING is service time
+    name = 'rekey_stage_duration_seconds'
+    lines = [
+        f'# HELP {name} Seconds spent in a status before moving on.',
+        f'# TYPE {name} histogram',
+    ]
+
+    for (kind, previous), (count, total, *buckets) in sorted(totals.stages.items()):
+        labels = f'kind="{kind}",status="{previous}"'
+        for bucket, le in zip(BUCKETS, buckets):
+            lines.append(f'{name}_bucket{{{labels},le="{bucket}"}} {le}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f'{name}_sum{{{labels}}} {total}')
+        lines.append(f'{name}_count{{{labels}}} {count}')
+
+    return lines
+
+
+def status_counters():
+    # status="ERROR" gives error rates
+    name = 'rekey_status_changes_total'
+    lines = [
+        f'# HELP {name} Status changes, by the status entered.',
+        f'# TYPE {name} counter',
+    ]
+
+    for (kind, status), count in sorted(totals.statuses.items()):
+        lines.append(f'{name}{{kind="{kind}",status="{status}"}} {count}')
+
+    return lines
+
+
+def status_gauges():
+    name = 'rekey_objects'
+    lines = [
+        f'# HELP {name} Tracks and files currently in each status.',
+        f'# TYPE {name} gauge',
+    ]
+
+    for model in [Track, TrackFile]:
+        rows = model.select(model.status, fn.COUNT(model.id).alias('count')).group_by(model.status)
+        for row in rows:
+            lines.append(f'{name}{{kind="{model.__name__}",status="{status_name(row.status)}"}} {row.count}')
+
+    return lines
+
+
+def queue_gauges(red):
+    depth = 'rekey_queue_depth'
+    inflight = 'rekey_queue_inflight'
+    lines = [
+        f'# HELP {depth} Jobs waiting in each queue.',
+        f'# TYPE {depth} gauge',
+    ]
+    lines += [f'{depth}{{queue="{q.value}"}} {job_queue(red, q.value).depth()}' for q in Queue]
+    lines += [
+        f'# HELP {inflight} Jobs popped by a worker and not yet acked.',
+        f'# TYPE {inflight} gauge',
+    ]
+    lines += [f'{inflight}{{queue="{q.value}"}} {job_queue(red, q.value).inflight_count()}' for q in Queue]
+    return lines
@@ -0,0 +1,75 @@
+from peewee import IntegerField, CharField, FloatField
+from playhouse.migrate import SqliteMigrator
+
+from server.log import logger
+
+
+def unique_track_uuid(db, migrator):
+    migrator.add_index('track', ('uuid',), True).run()
+
+
+def unique_track_files(db, migrator):
+    # prep_file used to get-or-create without a constraint, keep the newest of any duplicates
+    db.execute_sql(
+        'DELETE FROM trackfile WHERE id NOT IN '
+        '(SELECT MAX(id) FROM trackfile GROUP BY track_id, key_offset, file_type)'
+    )
+    migrator.add_index('trackfile', ('track_id', 'key_offset', 'file_type'), True).run()
+
+
+def track_remaining(db, migrator):
+    # db is mid-import when migrations run, but its models are defined by then
+    from server.db import FileStatus
+
+    migrator.add_column('track', 'remaining', IntegerField(default=0)).run()
+    db.execute_sql(
+        'UPDATE track SET remaining = (SELECT COUNT(*) FROM trackfile '
+        'WHERE trackfile.track_id = track.id AND trackfile.status NOT IN (?, ?))',
+        (FileStatus.DONE.value, FileStatus.ERROR.value)
+    )
+
+
+def track_offsets(db, migrator):
+    migrator.add_column('track', 'offsets', CharField(null=True)).run()
+
+
+def track_key_strength(db, migrator):
+    migrator.add_column('track', 'key_strength', FloatField(null=True)).run()
+
+
+def drop_track_updated_index(db, migrator):
+    # the song list pages by id now, updated moves with every status change
+    db.execute_sql('DROP INDEX IF EXISTS track_updated_id')
+
+
+# append only; a db's user_version is the number of these it has run
+MIGRATIONS = [
+    unique_track_uuid,
+    unique_track_files,
+    track_remaining,
+    track_offsets,
+    track_key_strength,
+    drop_track_updated_index,
+]
+
+
+def migrate(db, models):
+    # every worker imports db at start, the write lock makes them take turns
+    db.connect(reuse_if_open=True)
+    try:
+        with db.atomic('IMMEDIATE'):
+            if not any(db.table_exists(model._meta.table_name) for model in models):
+                # a new db gets the current schema, which already includes every migration
+                db.create_tables(models)
+                db.pragma('user_version', len(MIGRATIONS))
+                return
+
+            version = db.pragma('user_version')
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+                logger.info("migrating db to version %s: %s", number, migration.__name__)
+                migration(db, SqliteMigrator(db))
+                db.pragma('user_version', number)
+
+            db.create_tables(models, safe=True)
+    finally:
+        db.close()
@@ -0,0 +1,193 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from server.audio import read_audio, to_float, write_wav
+
+N_FFT = 2048
+HOP = N_FFT // 4
+BLOCK = 512
+# a streamed shift holds a block's spectra at a time, smaller blocks keep that down
+STREAM_BLOCK = 128
+# half-width of the streaming resampler's kernel, and how many output frames it works out at once
+TAPS = 8
+KERNEL = np.arange(1 - TAPS, TAPS + 1)
+CHUNK = 8192
+TWO_PI = 2 * np.pi
+
+# periodic hann, whose squares sum to 1.5 at 4x overlap
+WINDOW = (0.5 - 0.5 * np.cos(TWO_PI * np.arange(N_FFT) / N_FFT)).astype(np.float32)
+WINDOW_GAIN = 1.5
+ADVANCE = np.linspace(0, np.pi * HOP, N_FFT // 2 + 1)
+
+_source = None
+
+
+def load_source(in_file):
+    # process pool initializer: every worker maps the same source, so it is read once
+    global _source
+    _source = read_audio(in_file)
+
+
+def source():
+    return _source
+
+
+def render(offset, outfile):
+    samples, rate = _source
+    write_wav(outfile, shift(samples, offset), rate)
+    return outfile
+
+
+def shift(samples, semitones):
+    if semitones == 0:
+        return to_float(samples)
+
+    ratio = 2.0 ** (semitones / 12.0)
+    frames = len(samples)
+    shifted = np.empty((frames, samples.shape[1]), dtype=np.float32)
+    for channel in range(samples.shape[1]):
+        mono = to_float(samples[:, channel])
+        shifted[:, channel] = resample(stretch(mono, ratio), frames)
+
+    return shifted
+
+
+def shift_blocks(samples, semitones, block=STREAM_BLOCK):
+    # the shifted song a block at a time, holding only the overlap between blocks, so a stream never has all of it
+    frames = len(samples)
+    if semitones == 0:
+        for start in range(0, frames, block * HOP):
+            yield to_float(samples[start:start + block * HOP])
+        return
+
+    ratio = 2.0 ** (semitones / 12.0)
+    channels = range(samples.shape[1])
+    resamplers = [Resampler(ratio, frames) for _ in channels]
+    # every channel steps through the same frames, so their pieces line up
+    for pieces in zip(*[stretch_blocks(samples[:, channel], ratio, block) for channel in channels]):
+        yield np.stack([resampler.push(piece) for resampler, piece in zip(resamplers, pieces)], axis=1)
+
+    yield np.stack([resampler.push(np.zeros(0, dtype=np.float32), final=True) for resampler in resamplers], axis=1)
+
+
+def stretch(x, ratio):
+    return np.concatenate(list(stretch_blocks(to_float(x), ratio)))
+
+
+def stretch_blocks(x, ratio, block_size=BLOCK):
+    # phase vocoder, in blocks of output frames; each block's output is final once the next one starts past it
+    count = (len(x) + N_FFT // 2) // HOP + 1
+    steps = np.arange(0, count - 1, 1.0 / ratio)
+    # the analysis is padded by half a frame up front, which is trimmed back off the output
+    skip, length = N_FFT // 2, int(len(x) * ratio)
+
+    tail = np.zeros(N_FFT, dtype=np.float32)
+    phase = None
+    for start in range(0, len(steps), block_size):
+        block = steps[start:start + block_size]
+        idx = block.astype(int)
+        alpha = (block - idx)[:, None]
+
+        segment = window(x, idx[0] * HOP - N_FFT // 2, (idx[-1] + 1) * HOP + N_FFT // 2)
+        spec = np.fft.rfft(sliding_window_view(segment, N_FFT)[::HOP] * WINDOW, axis=1)
+        left = spec[idx - idx[0]]
+        right = spec[idx - idx[0] + 1]
+
+        magnitude = (1 - alpha) * np.abs(left) + alpha * np.abs(right)
+        delta = np.angle(right) - np.angle(left) - ADVANCE
+        delta -= TWO_PI * np.round(delta / TWO_PI)
+        increments = ADVANCE + delta
+
+        if phase is None:
+            phase = np.angle(left[0])
+        accumulated = phase + np.cumsum(increments, axis=0) - increments
+        phase = np.mod(accumulated[-1] + increments[-1], TWO_PI)
+
+        synth = np.fft.irfft(magnitude * np.exp(1j * accumulated), n=N_FFT, axis=1) * WINDOW
+        out = np.zeros(len(block) * HOP + N_FFT, dtype=np.float32)
+        out[:N_FFT] = tail
+        overlap_add(out, synth, 0)
+
+        done, tail = out[:len(block) * HOP], out[len(block) * HOP:]
+        piece, skip, length = trim(done / WINDOW_GAIN, skip, length)
+        yield piece
+
+    yield trim(tail / WINDOW_GAIN, skip, length)[0]
+
+
+def window(x, lo, hi):
+    # x[lo:hi] as float, zero outside the song
+    segment = np.zeros(hi - lo, dtype=np.float32)
+    start, stop = max(lo, 0), min(hi, len(x))
+    if stop > start:
+        segment[start - lo:stop - lo] = to_float(x[start:stop])
+    return segment
+
+
+def trim(piece, skip, length):
+    # drops what is left of the lead-in and stops at the song's length, returning what is left of each
+    dropped = min(skip, len(piece))
+    piece = piece[dropped:][:length]
+    return piece, skip - dropped, length - len(piece)
+
+
+def overlap_add(out, frames, base):
+    span = len(frames) * HOP
+    for i in range(N_FFT // HOP):
+        at = base + i * HOP
+        out[at:at + span] += frames[:, i * HOP:(i + 1) * HOP].reshape(-1)
+
+
+class Resampler:
+    # windowed sinc interpolation, fed a piece at a time; resample() needs the whole song for its fft.
+    # output frame j is read at input frame j * step, low-passed under the output's nyquist when step > 1
+    def __init__(self, step, length):
+        self.step = step
+        self.length = length
+        self.cutoff = min(1.0, 1.0 / step)
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.offset = 0
+        self.produced = 0
+
+    def push(self, piece, final=False):
+        self.buffer = np.concatenate([self.buffer, piece])
+        available = self.offset + len(self.buffer)
+        ready = self.length if final else min(self.length, int((available - TAPS) / self.step))
+
+        out = [self.interpolate(np.arange(start, min(start + CHUNK, ready)))
+               for start in range(self.produced, ready, CHUNK)]
+        self.produced = max(ready, self.produced)
+
+        # keep only the input the next output frames still reach back to
+        drop = min(max(0, int(self.produced * self.step) - TAPS) - self.offset, len(self.buffer))
+        if drop > 0:
+            self.buffer = self.buffer[drop:]
+            self.offset += drop
+
+        return np.concatenate(out) if out else np.zeros(0, dtype=np.float32)
+
+    def interpolate(self, frames):
+        at = frames * self.step
+        taps = np.floor(at).astype(int)[:, None] + KERNEL
+        distance = at[:, None] - taps
+        weights = self.cutoff * np.sinc(self.cutoff * distance) * (0.5 + 0.5 * np.cos(np.pi * distance / TAPS))
+
+        if not len(self.buffer):
+            return np.zeros(len(frames), dtype=np.float32)
+
+        # frames near the ends reach past the song, which counts as silence
+        idx = taps - self.offset
+        inside = (idx >= 0) & (idx < len(self.buffer))
+        values = np.where(inside, self.buffer[np.clip(idx, 0, len(self.buffer) - 1)], 0)
+        return np.sum(values * weights, axis=1).astype(np.float32)
+
+
+def resample(x, length):
+    spec = np.fft.rfft(x)
+    bins = length // 2 + 1
+    if len(spec) >= bins:
+        spec = spec[:bins]
+    else:
+        spec = np.pad(spec, (0, bins - len(spec)))
+
+    return np.fft.irfft(spec, n=length) * (length / len(x))
@@ -1,9 +1,16 @@
 #!/usr/bin/env python
+import multiprocessing
 import os
+import queue
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
-from server.consts import RUBBERBAND_INPUT_DIR, RUBBERBAND_OUTPUT_DIR, RUBBERBAND_IMAGE, RUBBERBAND_SPLITS_DIR, DOCKER_USER
-from server.db import Queue, TrackStatus, queue_encode, TrackFile, FileStatus, FileType
+from server.consts import RUBBERBAND_INPUT_DIR, RUBBERBAND_OUTPUT_DIR, RUBBERBAND_IMAGE, RUBBERBAND_SPLITS_DIR, DOCKER_USER, \
+    REKEY_BATCH, REKEY_WORKERS, REKEY_FUSED, S3_BUCKET
+from server.db import Queue, TrackStatus, queue_encode, TrackFile, FileStatus, FileType, Track, TrackFlags, \
+    cleanup_check
 from server.log import logger
+from server.pitch import load_source, render
+from server.stream import render_stream
 from server.task import Task, volume
 from server.util import assert_file
 
@@ -20,18 +27,15 @@ class RubberbandTask(Task):
 
         logger.info("Starting rubberband: %s", track.title)
 
-        input_dir = "/input"
         output_dir = "/output"
 
-        if track_file.is_type([FileType.INSTRUMENTAL_AUDIO, FileType.INSTRUMENTAL_VIDEO]):
-            input_src = RUBBERBAND_SPLITS_DIR
-            input_file = f"{track_file.track.id}/accompaniment.wav"
-        else:
-            input_src = RUBBERBAND_INPUT_DIR
-            input_file = f"{track_file.track.id}.wav"
+        input_src, input_file = source_for(track_file)
+        input_dir = "/splits" if input_src == RUBBERBAND_SPLITS_DIR else "/input"
 
+        # both sources are always mounted, so every file of every track can share a pooled container
         volumes = [
-            volume(input_src, input_dir),
+            volume(RUBBERBAND_INPUT_DIR, "/input"),
+            volume(RUBBERBAND_SPLITS_DIR, "/splits"),
             volume(RUBBERBAND_OUTPUT_DIR, output_dir),
         ]
 
@@ -43,11 +47,131 @@ class RubberbandTask(Task):
 
         command = f"'{offset}' {input_dir}/{input_file} {output_dir}/{out_base}"
         logger.info("command: %s", command)
-        self.docker.containers.run(RUBBERBAND_IMAGE, command=command, remove=True, volumes=volumes, user=DOCKER_USER)
+        self.run_container(RUBBERBAND_IMAGE, command, volumes, user=DOCKER_USER)
 
         outfile = os.path.join(RUBBERBAND_OUTPUT_DIR, out_base)
         queue_encode(track_file, outfile, self.redis)
 
 
+class RubberbandBatchTask(Task):
+    # rekeys every queued file of a track in one job, reading each source once
+    def __init__(self):
+        super(RubberbandBatchTask, self).__init__(Queue.REKEY_BATCH.value, Track)
+
+    def work(self, track: Track, opts):
+        track.expect_status([TrackStatus.NEEDS_REKEY, TrackStatus.REKEYING])
+        track.set_status(TrackStatus.REKEYING)
+
+        logger.info("Starting batch rekey: %s", track.title)
+
+        track_files = TrackFile.select().where(
+            TrackFile.track == track,
+            TrackFile.status == FileStatus.QUEUED
+        ).order_by(TrackFile.id)
+
+        sources = {}
+        for track_file in track_files:
+            sources.setdefault(os.path.join(*source_for(track_file)), []).append(track_file)
+
+        novox_first = track.has_flag(TrackFlags.NOVOX_FIRST)
+        for in_file in sorted(sources, key=lambda s: novox_first != is_split_source(s)):
+            if REKEY_FUSED:
+                self.rekey_fused(in_file, sources[in_file])
+            else:
+                self.rekey(in_file, sources[in_file])
+
+        if REKEY_FUSED:
+            cleanup_check(track, self.redis)
+
+    def rekey(self, in_file, track_files):
+        assert_file(in_file)
+        for track_file in track_files:
+            track_file.set_status(FileStatus.WORKING)
+
+        workers = min(REKEY_WORKERS, len(track_files))
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, context, initializer=load_source, initargs=(in_file,)) as pool:
+            futures = {}
+            for track_file in track_files:
+                outfile = os.path.join(RUBBERBAND_OUTPUT_DIR, track_file.nice_name(ext='wav'))
+                futures[pool.submit(render, track_file.key_offset, outfile)] = track_file
+
+            for future in as_completed(futures):
+                track_file = futures[future]
+                try:
+                    queue_encode(track_file, future.result(), self.redis)
+                except Exception as e:
+                    logger.exception(e)
+                    track_file.error_message = str(e)
+                    track_file.set_status(track_file.error_status)
+
+    def rekey_fused(self, in_file, track_files):
+        # streams each key through ffmpeg into s3; workers report stage changes over `events`
+        assert_file(in_file)
+        by_id = {track_file.id: track_file for track_file in track_files}
+        for track_file in track_files:
+            track_file.set_status(FileStatus.WORKING)
+
+        workers = min(REKEY_WORKERS, len(track_files))
+        context = multiprocessing.get_context('spawn')
+        with context.Manager() as manager, \
+                ProcessPoolExecutor(workers, context, initializer=load_source, initargs=(in_file,)) as pool:
+            events = manager.Queue()
+            pending = {}
+            for track_file in track_files:
+                title = f"{track_file.nice_key()} - {track_file.track.title}"
+                future = pool.submit(render_stream, track_file.id, track_file.key_offset, S3_BUCKET,
+                                     track_file.nice_name(), title, events)
+                pending[future] = track_file
+
+            while pending:
+                done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                apply_events(events, by_id)
+
+                for future in done:
+                    track_file = pending.pop(future)
+                    try:
+                        future.result()
+                        track_file.file_url = track_file.public_url('mp3')
+                        track_file.save()
+                        track_file.next_status()
+                    except Exception as e:
+                        logger.exception(e)
+                        track_file.error_message = str(e)
+                        track_file.set_status(track_file.error_status)
+
+
+def apply_events(events, by_id):
+    # the fused path passes through every stage at once, so each one is entered as soon as it is queued
+    stages = {
+        FileStatus.ENCODING: FileStatus.NEEDS_ENCODING,
+        FileStatus.UPLOADING: FileStatus.NEEDS_UPLOAD,
+    }
+    while True:
+        try:
+            file_id, status = events.get_nowait()
+        except queue.Empty:
+            return
+
+        status = FileStatus[status]
+        track_file = by_id[file_id]
+        track_file.set_status(stages[status])
+        track_file.set_status(status)
+
+
+def source_for(track_file):
+    if track_file.is_type([FileType.INSTRUMENTAL_AUDIO, FileType.INSTRUMENTAL_VIDEO]):
+        return RUBBERBAND_SPLITS_DIR, f"{track_file.track.id}/accompaniment.wav"
+
+    return RUBBERBAND_INPUT_DIR, f"{track_file.track.id}.wav"
+
+
+def is_split_source(in_file):
+    return in_file.startswith(RUBBERBAND_SPLITS_DIR)
+
+
 if __name__ == '__main__':
-    RubberbandTask().watch()
+    if REKEY_BATCH:
+        RubberbandBatchTask().watch()
+    else:
+        RubberbandTask().watch()
@@ -0,0 +1,20 @@
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from server.consts import S3_ENDPOINT_URL, S3_MAX_POOL_CONNECTIONS, S3_MULTIPART_CHUNK_SIZE, S3_MAX_CONCURRENCY
+
+transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_CHUNK_SIZE,
+    multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+    max_concurrency=S3_MAX_CONCURRENCY,
+)
+
+
+def s3_client():
+    # one client per process; boto3 clients are thread-safe and pool their connections
+    return boto3.client(
+        's3',
+        endpoint_url=S3_ENDPOINT_URL,
+        config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+    )
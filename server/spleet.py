@@ -1,11 +1,16 @@
 #!/usr/bin/env python
+import json
 import os
+import time
 
 from log import logger
-from server.consts import SPLEETER_IMAGE, SPLEETER_INPUT_DIR, SPLEETER_OUTPUT_DIR, ORIGINAL_KEY, DOCKER_USER
+from server.audio import write_pcm
+from server.consts import SPLEETER_IMAGE, SPLEETER_INPUT_DIR, SPLEETER_OUTPUT_DIR, ORIGINAL_KEY, DOCKER_USER, \
+    SPLEETER_SERVICE, SPLEETER_QUEUE, SPLEETER_TIMEOUT, PCM_STORE, SPLEETER_BATCH_SIZE, SPLEETER_BATCH_WINDOW_MS
 from server.db import Track, Queue, TrackStatus, queue_encode, TrackFile, FileType
+from server.errs import JobError
 from server.task import Task, volume
-from server.util import assert_file
+from server.util import assert_file, make_key
 
 
 class SpleetTask(Task):
@@ -13,11 +18,106 @@ class SpleetTask(Task):
         super(SpleetTask, self).__init__(Queue.SPLIT.value, Track)
 
     def work(self, model: Track, opts):
+        if SPLEETER_BATCH_SIZE > 1 and not SPLEETER_SERVICE:
+            return self.work_batch(model)
+
         # model.expect_status(TrackStatus.NEEDS_SPLIT)
         model.set_status(TrackStatus.SPLITTING)
 
         logger.info("Starting spleet: %s", model.title)
 
+        basename = '{}.wav'.format(model.id)
+        in_file = os.path.join(SPLEETER_INPUT_DIR, basename)
+        assert_file(in_file)
+
+        if SPLEETER_SERVICE:
+            self.separate_remote(model, basename)
+        else:
+            self.separate([model])
+
+        self.finish(model)
+
+    def work_batch(self, model: Track):
+        # handle acks the job that started the batch, the ones collected here are acked once their track is done
+        keys, tracks = self.collect(model)
+        try:
+            self.separate_batch(tracks)
+        finally:
+            for key in keys:
+                self.queue.ack(key)
+
+    def collect(self, model):
+        keys, tracks = [], [model]
+        deadline = time.monotonic() + SPLEETER_BATCH_WINDOW_MS / 1000
+        while len(tracks) < SPLEETER_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            # popped into this worker's in-flight list, so they are requeued if it dies mid batch
+            key = self.queue.pop(timeout=remaining)
+            if not key:
+                break
+
+            keys.append(key)
+            try:
+                tracks.append(self.find(key)[0])
+            except JobError as e:
+                logger.exception(e)
+
+        return keys, tracks
+
+    def separate_batch(self, tracks):
+        ready = []
+        for track in tracks:
+            track.set_status(TrackStatus.SPLITTING)
+            try:
+                assert_file(os.path.join(SPLEETER_INPUT_DIR, '{}.wav'.format(track.id)))
+                ready.append(track)
+            except Exception as e:
+                self.fail(track, e)
+
+        if not ready:
+            return
+
+        logger.info("Starting spleet of %s tracks: %s", len(ready), ', '.join(t.title or str(t.id) for t in ready))
+        failed = None
+        try:
+            self.separate(ready)
+        except Exception as e:
+            failed = e
+
+        separated = ready
+        if failed and len(ready) == 1:
+            return self.fail(ready[0], failed)
+        if failed:
+            # one unreadable input fails the whole run, so find it by separating the rest on their own
+            logger.warning("Spleet of %s tracks failed, retrying one at a time: %s", len(ready), failed)
+            separated = []
+            for track in ready:
+                try:
+                    self.separate([track])
+                    separated.append(track)
+                except Exception as e:
+                    self.fail(track, e)
+
+        for track in separated:
+            try:
+                self.finish(track)
+            except Exception as e:
+                self.fail(track, e)
+
+    def finish(self, model: Track):
+        outfile = os.path.join(SPLEETER_OUTPUT_DIR, str(model.id), 'accompaniment.wav')
+        assert_file(outfile)
+        if PCM_STORE:
+            write_pcm(outfile)
+
+        track_file = TrackFile.prep_file(model, ORIGINAL_KEY, FileType.INSTRUMENTAL_AUDIO)
+        queue_encode(track_file, outfile, self.redis)
+        model.next_status(self.redis)
+
+    def separate(self, tracks):
         input_dir = "/input"
         output_dir = "/output"
 
@@ -26,44 +126,41 @@ class SpleetTask(Task):
             volume(SPLEETER_OUTPUT_DIR, output_dir),
         ]
 
-        basename = '{}.wav'.format(model.id)
-        in_file = os.path.join(SPLEETER_INPUT_DIR, basename)
-        assert_file(in_file)
-
-        command = "separate -o {} {}/{}".format(output_dir, input_dir, basename)
+        # spleeter writes each input's stems to <output>/<input name>/
+        inputs = ' '.join("{}/{}.wav".format(input_dir, track.id) for track in tracks)
+        command = "separate -o {} {}".format(output_dir, inputs)
         logger.info("command: %s", command)
-        self.docker.containers.run(
-            SPLEETER_IMAGE,
-            command=command,
-            remove=True,
-            volumes=volumes,
-            # user=DOCKER_USER
-        )
+        self.run_container(SPLEETER_IMAGE, command, volumes)
 
         # vocal only
         # os.path.join(SPLEETER_OUTPUT_DIR, model.id, 'vocals.wav'),
 
-        outfile = os.path.join(SPLEETER_OUTPUT_DIR, str(model.id), 'accompaniment.wav')
-        assert_file(outfile)
-
-        spleet_dir = os.path.join(SPLEETER_OUTPUT_DIR, str(model.id))
         try:
-            self.docker.containers.run(
+            # the whole output dir is mounted, so one pooled container serves every track
+            self.run_container(
                 "alpine",
-                command=f"chown -R {DOCKER_USER}:{DOCKER_USER} /input",
-                tty=True,
-                remove=True,
-                volumes=[
-                    f"{spleet_dir}:/input"
-                ],
+                "chown -R {}:{} {}".format(DOCKER_USER, DOCKER_USER, ' '.join(f"/input/{t.id}" for t in tracks)),
+                [volume(SPLEETER_OUTPUT_DIR, "/input")],
             )
         except Exception as e:
             logger.exception(e)
             pass
 
-        track_file = TrackFile.prep_file(model, ORIGINAL_KEY, FileType.INSTRUMENTAL_AUDIO)
-        queue_encode(track_file, outfile, self.redis)
-        model.next_status(self.redis)
+    def separate_remote(self, model, basename):
+        # the resident spleeter service mounts the same volumes at /input and /output
+        reply = make_key(SPLEETER_QUEUE, 'done', model.id)
+        self.redis.delete(reply)
+        job = dict(input=f"/input/{basename}", output="/output", reply=reply)
+        logger.info("spleeter service: %s", job)
+        self.redis.rpush(SPLEETER_QUEUE, json.dumps(job))
+
+        result = self.redis.blpop(reply, timeout=SPLEETER_TIMEOUT)
+        if not result:
+            raise JobError(f'spleeter service timed out on {basename}')
+
+        result = json.loads(result[1])
+        if not result.get('ok'):
+            raise JobError('spleeter service failed: {}'.format(result.get('error')))
 
 
 if __name__ == '__main__':
@@ -5,6 +5,10 @@ export PYTHONPATH=$(dirname $here)
 applog=/var/log/app.log
 errlog=/var/log/error.log
 
+export REKEY_CONCURRENCY=${REKEY_CONCURRENCY:-3}
+# every open event stream holds a connection, gevent serves them as greenlets instead of threads
+export WEB_SERVER=${WEB_SERVER:-gevent}
+
 runapp(){
   local app=${1}
   nohup ./${app} 2>${errlog} >${applog} &
@@ -13,16 +17,18 @@ runapp(){
 runapp app.py
 sleep 2
 
-runapp metadata.py
-runapp download.py
+if [ "${FETCH_FUSED}" == "1" ]; then
+  runapp fetch.py
+else
+  runapp metadata.py
+  runapp download.py
+fi
 runapp keydetect.py
 runapp spleet.py
 runapp encode.py
 runapp upload.py
 runapp cleanup.py
 
-runapp rubberband.py
-runapp rubberband.py
 runapp rubberband.py
 
 exec tail -f $applog $errlog
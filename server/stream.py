@@ -0,0 +1,63 @@
+import subprocess
+import threading
+
+import numpy as np
+
+from server.pitch import shift_blocks, source
+from server.s3 import s3_client, transfer_config
+
+_s3 = None
+
+
+def render_stream(file_id, offset, bucket, name, title, events):
+    # pitch shift -> ffmpeg stdin, ffmpeg stdout -> multipart upload. the shift goes a block at a time, so neither
+    # disk nor memory ever holds the whole rekeyed song
+    global _s3
+    if not _s3:
+        _s3 = s3_client()
+
+    samples, rate = source()
+
+    command = [
+        'ffmpeg', '-loglevel', 'error',
+        '-f', 'f32le', '-ar', str(rate), '-ac', str(samples.shape[1]), '-i', 'pipe:0',
+        '-metadata', f'title={title}',
+        '-f', 'mp3', 'pipe:1',
+    ]
+    events.put((file_id, 'ENCODING'))
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    failed = []
+    writer = threading.Thread(target=feed, args=(proc, shift_blocks(samples, offset), failed))
+    writer.start()
+
+    events.put((file_id, 'UPLOADING'))
+    try:
+        _s3.upload_fileobj(proc.stdout, bucket, name, Config=transfer_config)
+    except Exception:
+        proc.kill()
+        raise
+    finally:
+        writer.join()
+        errors = proc.stderr.read().decode('utf-8', 'replace')
+        proc.wait()
+
+    # ffmpeg would happily finish a song cut short by a failed shift
+    if failed:
+        raise failed[0]
+    if proc.returncode:
+        raise RuntimeError(f'ffmpeg exited {proc.returncode}: {errors}')
+
+    return file_id
+
+
+def feed(proc, blocks, failed):
+    try:
+        for block in blocks:
+            proc.stdin.write(np.ascontiguousarray(block, dtype='<f4').tobytes())
+    except BrokenPipeError:
+        pass
+    except Exception as e:
+        failed.append(e)
+    finally:
+        proc.stdin.close()
@@ -1,38 +1,86 @@
+import atexit
 import json
 import os
+import queue
+import shlex
+import threading
 import time
 from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import docker
 from redis.client import StrictRedis
 
-from server.consts import REDIS_HOST
+from server.cache import settle
+from server.consts import REDIS_HOST, QUEUE_LEASE_SECONDS, QUEUE_PREFETCH, CONTAINER_POOL, CONTAINER_POOL_MAX_JOBS, \
+    CONTAINER_POOL_TIMINGS, concurrency_for
+from server.db import db, Track
 from server.errs import JobError
+from server.jobs import job_queue, worker_name
 from server.log import logger
 from server.util import unkey
 
 
 class Task(ABC):
 
-    def __init__(self, channel, model):
+    def __init__(self, channel, model, concurrency=None):
         self.channel = channel
         self.model = model
+        self.concurrency = concurrency or concurrency_for(channel)
         self.docker = docker.from_env()
         self.redis = StrictRedis(host=REDIS_HOST)
+        self.queue = job_queue(self.redis, channel)
+        self.pools = {}
+        self.pools_lock = threading.Lock()
 
     def watch(self):
-        while True:
-            time.sleep(1)
-            key: bytes = self.redis.lpop(self.channel)
-            if not key:
-                continue
+        self.queue.renew()
+        threading.Thread(target=self.keep_alive, daemon=True).start()
+        logger.info("watching %s with concurrency %s", self.channel, self.concurrency)
 
-            try:
-                obj, opts = self.find(key.decode('utf-8'))
+        # only pop what the pool can work on, plus a bounded prefetch
+        slots = threading.Semaphore(self.concurrency + QUEUE_PREFETCH)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while True:
+                slots.acquire()
+                try:
+                    key = self.queue.pop()
+                except Exception as e:
+                    # a redis hiccup or a bad job at the head of the queue shouldn't take the worker down
+                    logger.exception(e)
+                    key = None
+                    time.sleep(1)
+
+                if not key:
+                    slots.release()
+                    continue
+
+                future = pool.submit(self.handle, key)
+                future.add_done_callback(lambda f: slots.release())
+
+    def handle(self, key):
+        try:
+            with db.connection_context():
+                obj, opts = self.find(key)
                 self.start(obj, opts)
-            except JobError as e:
+        except JobError as e:
+            logger.exception(e)
+        finally:
+            self.queue.ack(key)
+
+    def keep_alive(self):
+        while True:
+            try:
+                self.queue.renew()
+                requeued = self.queue.reap()
+                if requeued:
+                    logger.warning("requeued %s expired jobs on %s", requeued, self.channel)
+            except Exception as e:
                 logger.exception(e)
 
+            time.sleep(QUEUE_LEASE_SECONDS / 3)
+
     def find(self, key):
         parts = unkey(key)
         model_name = parts.pop(0)
@@ -53,14 +101,172 @@ class Task(ABC):
         try:
             self.work(model, opts)
         except Exception as e:
-            logger.exception(e)
-            model.error_message = str(e)
-            model.set_status(model.error_status)
+            self.fail(model, e)
+
+    def fail(self, model, e):
+        logger.exception(e)
+        model.error_message = str(e)
+        model.set_status(model.error_status)
+        if isinstance(model, Track):
+            settle(model, self.redis)
 
     @abstractmethod
     def work(self, model, opts):
         pass
 
+    def run_container(self, image, command, volumes, user=None, environment=None):
+        if not CONTAINER_POOL:
+            return self.docker.containers.run(image, command=command, remove=True, volumes=volumes, user=user,
+                                              environment=environment)
+
+        key = (image, tuple(volumes), user)
+        with self.pools_lock:
+            if key not in self.pools:
+                self.pools[key] = ContainerPool(self.docker, image, volumes, self.concurrency, CONTAINER_POOL_MAX_JOBS,
+                                                user=user, alive=self.is_alive, channel=self.channel)
+            pool = self.pools[key]
+
+        return pool.run(command, environment=environment)
+
+    def is_alive(self, worker):
+        return bool(self.redis.exists(self.queue.lease_for(worker)))
+
+
+class ContainerPool:
+    # keeps up to `size` idle containers of an image, with the stage's volumes mounted, and runs each job in one
+    # through exec, so a job doesn't pay for create, start and remove. a container is recycled after `max_jobs`.
+    def __init__(self, client, image, volumes, size, max_jobs, user=None, alive=None, channel=None):
+        self.client = client
+        self.image = image
+        self.volumes = volumes
+        self.size = size
+        self.max_jobs = max_jobs
+        self.user = user
+        self.labels = {'rekey.pool': channel or image, 'rekey.pool.worker': worker_name()}
+        self.idle = queue.Queue()
+        # every container this pool started and hasn't removed, idle or checked out
+        self.containers = {}
+        self.jobs = {}
+        self.started = 0
+        self.lock = threading.Lock()
+        # only the latest samples per phase, a worker runs for weeks
+        self.timings = defaultdict(lambda: deque(maxlen=CONTAINER_POOL_TIMINGS))
+
+        # the image's own entrypoint runs through exec; the container itself just idles
+        self.entrypoint = client.images.get(image).attrs['Config'].get('Entrypoint') or []
+        if alive:
+            self.reap(alive)
+        atexit.register(self.close)
+
+    def run(self, command, environment=None):
+        container = self.checkout()
+        try:
+            started = time.perf_counter()
+            code, output = container.exec_run(self.entrypoint + shlex.split(command), user=self.exec_user(),
+                                              environment=environment)
+            self.timed('exec', started)
+        except Exception:
+            self.discard(container)
+            raise
+
+        self.jobs[container.id] += 1
+        if self.jobs[container.id] >= self.max_jobs:
+            self.discard(container)
+        else:
+            self.idle.put(container)
+
+        if code:
+            output = (output or b'').decode('utf-8', 'replace')
+            raise JobError(f'{self.image} exited {code}: {output[-1000:]}')
+        return output
+
+    def checkout(self):
+        while True:
+            try:
+                container = self.idle.get_nowait()
+            except queue.Empty:
+                container = self.start_or_wait()
+
+            started = time.perf_counter()
+            healthy = self.is_healthy(container)
+            self.timed('health', started)
+            if healthy:
+                return container
+
+            logger.warning("%s pool: container %s is %s, replacing it", self.image, container.short_id,
+                           container.status)
+            self.discard(container)
+
+    def start_or_wait(self):
+        with self.lock:
+            can_start = self.started < self.size
+            if can_start:
+                self.started += 1
+
+        if not can_start:
+            return self.idle.get()
+
+        started = time.perf_counter()
+        try:
+            container = self.client.containers.run(self.image, entrypoint=['tail', '-f', '/dev/null'], detach=True,
+                                                   volumes=self.volumes, labels=self.labels)
+        except Exception:
+            with self.lock:
+                self.started -= 1
+            raise
+
+        self.timed('start', started)
+        self.containers[container.id] = container
+        self.jobs[container.id] = 0
+        return container
+
+    def is_healthy(self, container):
+        try:
+            container.reload()
+        except Exception as e:
+            logger.warning("%s pool: can't inspect %s: %s", self.image, container.short_id, e)
+            return False
+        return container.status == 'running'
+
+    def discard(self, container):
+        started = time.perf_counter()
+        try:
+            container.remove(force=True)
+        except Exception as e:
+            logger.warning("%s pool: can't remove %s: %s", self.image, container.short_id, e)
+
+        self.containers.pop(container.id, None)
+        self.jobs.pop(container.id, None)
+        with self.lock:
+            self.started -= 1
+        self.timed('recycle', started)
+
+    def reap(self, alive):
+        # containers left behind by this stage's workers that have since died
+        found = self.client.containers.list(all=True, filters={'label': f"rekey.pool={self.labels['rekey.pool']}"})
+        for container in found:
+            worker = container.labels.get('rekey.pool.worker')
+            if worker != self.labels['rekey.pool.worker'] and not alive(worker):
+                logger.info("%s pool: removing %s, left by %s", self.image, container.short_id, worker)
+                container.remove(force=True)
+
+    def close(self):
+        # checked out ones too, a job still running at exit would otherwise leave its container behind
+        for container in list(self.containers.values()):
+            try:
+                container.remove(force=True)
+            except Exception as e:
+                logger.warning("%s pool: %s", self.image, e)
+            self.containers.pop(container.id, None)
+
+    def exec_user(self):
+        return str(self.user) if self.user is not None else ''
+
+    def timed(self, phase, started):
+        elapsed = time.perf_counter() - started
+        self.timings[phase].append(elapsed)
+        logger.debug("%s pool: %s took %.3fs", self.image, phase, elapsed)
+
 
 def volume(host_path, container_path):
     return ':'.join([host_path, container_path])
@@ -1,30 +1,64 @@
 #!/usr/bin/env python
-import boto3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from botocore.exceptions import ClientError
 
-from server.consts import S3_BUCKET
-from server.db import Queue, TrackFile, FileStatus, cleanup_check, TrackStatus, TrackFlags
+from server.consts import S3_BUCKET, UPLOAD_BATCH, UPLOAD_BATCH_THREADS
+from server.db import Queue, Track, TrackFile, FileStatus, cleanup_check, TrackStatus, TrackFlags, claim, \
+    claim_pending
 from server.log import logger
+from server.s3 import s3_client, transfer_config
 from server.task import Task
 from server.util import assert_file
 
 
 class UploadTask(Task):
-    def __init__(self):
+    def __init__(self, s3=None):
         super(UploadTask, self).__init__(Queue.UPLOAD.value, TrackFile)
+        self.s3 = s3 or s3_client()
 
     def work(self, track_file: TrackFile, opts):
+        audio = opts.pop(0)
+        if UPLOAD_BATCH:
+            return self.upload_batch(track_file, audio)
+
         track_file.expect_status([FileStatus.NEEDS_UPLOAD, FileStatus.UPLOADING])
         track_file.set_status(FileStatus.UPLOADING)
-        audio = opts.pop(0)
+        self.upload(track_file, audio)
+        self.check_cleanup(track_file)
+
+    def upload_batch(self, track_file, audio):
+        # take every file of the track that is ready; their own jobs will find nothing left to do
+        uploads = claim_pending(Queue.UPLOAD, track_file.track, [FileStatus.NEEDS_UPLOAD], FileStatus.UPLOADING,
+                                self.redis)
+        if claim(track_file, [FileStatus.NEEDS_UPLOAD], FileStatus.UPLOADING):
+            uploads.append((track_file, audio))
+
+        if not uploads:
+            return
+
+        logger.info("uploading %s files for %s", len(uploads), track_file.track)
+        with ThreadPoolExecutor(max_workers=min(UPLOAD_BATCH_THREADS, len(uploads))) as pool:
+            futures = {pool.submit(self.upload, upload, path): upload for upload, path in uploads}
+            for future in as_completed(futures):
+                upload = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.exception(e)
+                    upload.error_message = str(e)
+                    upload.set_status(upload.error_status)
+
+        self.check_cleanup(track_file)
+
+    def upload(self, track_file, audio):
         assert_file(audio)
 
         bucket = S3_BUCKET
         nice_name = track_file.nice_name()
 
         try:
-            s3_client = boto3.client('s3')
-            s3_client.upload_file(audio, bucket, nice_name)
+            self.s3.upload_file(audio, bucket, nice_name, Config=transfer_config)
             track_file.file_url = track_file.public_url('mp3')
             track_file.save()
             track_file.next_status()
@@ -33,7 +67,9 @@ class UploadTask(Task):
             logger.exception(e)
             raise
 
-        track = track_file.track
+    def check_cleanup(self, track_file):
+        # the track may have moved on since this job loaded it
+        track = Track.get_by_id(track_file.track_id)
         is_rekey = track.is_status(TrackStatus.REKEYING)
         is_split = track.is_status(TrackStatus.SPLITTING)
         is_keying = track.is_status(TrackStatus.GETTING_KEY)
@@ -47,7 +83,7 @@ class UploadTask(Task):
         ]
         logger.info(check_conditions)
         if any(check_conditions):
-            cleanup_check(track_file.track, self.redis)
+            cleanup_check(track, self.redis)
 
 
 if __name__ == '__main__':
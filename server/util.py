@@ -1,7 +1,9 @@
 import json
 import os
+import re
 from datetime import datetime, timedelta
 from enum import Enum
+from urllib.parse import urlparse, parse_qs
 from uuid import UUID
 
 from peewee import Model
@@ -124,3 +126,21 @@ def list_right(lst):
 def assert_file(filename):
     if not os.path.isfile(filename):
         raise FileNotFoundError(filename)
+
+
+def video_id(url):
+    parsed = urlparse(url)
+    host = re.sub('^(www|m|music)\\.', '', (parsed.hostname or '').lower())
+    parts = [p for p in parsed.path.split('/') if p]
+    candidate = None
+
+    if host == 'youtu.be' and parts:
+        candidate = parts[0]
+    elif host in ['youtube.com', 'youtube-nocookie.com']:
+        if parts == ['watch']:
+            candidate = parse_qs(parsed.query).get('v', [None])[0]
+        elif len(parts) > 1 and parts[0] in ['shorts', 'embed', 'live', 'v']:
+            candidate = parts[1]
+
+    if candidate and re.match('^[A-Za-z0-9_-]{11}$', candidate):
+        return candidate
@@ -0,0 +1,88 @@
+import time
+from threading import Lock, Event
+
+
+class Write:
+    def __init__(self, fn):
+        self.fn = fn
+        self.done = Event()
+        self.lead = False
+        self.value = None
+        self.error = None
+
+
+class GroupCommit:
+    # writers in one process share a transaction: whoever arrives while a batch is committing
+    # queues up, and the next leader commits everything queued so far. every writer still
+    # returns only once its own write is committed.
+    def __init__(self, database, window=0):
+        self.database = database
+        self.window = window
+        self.lock = Lock()
+        self.pending = []
+        self.leading = False
+
+    def run(self, fn):
+        # a write inside someone's transaction must not be committed (or rolled back) by another thread
+        if self.database.in_transaction():
+            return fn()
+
+        write = Write(fn)
+        with self.lock:
+            self.pending.append(write)
+            write.lead = not self.leading
+            self.leading = True
+
+        if not write.lead:
+            write.done.wait()
+
+        # set up front, or handed over by the previous leader
+        if write.lead:
+            self.commit_pending()
+
+        if write.error:
+            raise write.error
+        return write.value
+
+    def commit_pending(self):
+        try:
+            if self.window:
+                time.sleep(self.window)
+
+            with self.lock:
+                batch, self.pending = self.pending, []
+
+            self.commit(batch)
+        finally:
+            # always pass leadership on, or every later write in this process waits forever
+            with self.lock:
+                if self.pending:
+                    self.pending[0].lead = True
+                    self.pending[0].done.set()
+                else:
+                    self.leading = False
+
+    def commit(self, batch):
+        opened = False
+        try:
+            if self.database.is_closed():
+                self.database.connect()
+                opened = True
+
+            with self.database.atomic('IMMEDIATE'):
+                for write in batch:
+                    try:
+                        with self.database.atomic():
+                            write.value = write.fn()
+                    except Exception as e:
+                        write.error = e
+        except Exception as e:
+            for write in batch:
+                write.error = write.error or e
+        finally:
+            try:
+                if opened:
+                    self.database.close()
+            finally:
+                for write in batch:
+                    write.done.set()
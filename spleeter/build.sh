@@ -0,0 +1,3 @@
+#!/bin/bash
+
+docker build -t spleeter-service .
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+import json
+import os
+import sys
+import wave
+
+import numpy as np
+from redis import StrictRedis
+
+env = os.environ.get
+REDIS_HOST = env('REDIS_HOST', 'localhost')
+QUEUE = env('SPLEETER_QUEUE', 'spleeter:jobs')
+MODEL = env('SPLEETER_MODEL', 'spleeter:2stems')
+BATCH_SIZE = int(env('SPLEETER_BATCH_SIZE', 4))
+SAMPLE_RATE = 44100
+OWNER = int(env('DOCKER_USER', 1000))
+
+
+class StubSeparator:
+    # stands in for the model where there is no network or gpu: everything is accompaniment
+    def separate(self, waveform):
+        return {
+            'vocals': np.zeros_like(waveform),
+            'accompaniment': waveform,
+        }
+
+
+class WavAdapter:
+    def load(self, path, sample_rate=SAMPLE_RATE):
+        with wave.open(path, 'rb') as w:
+            channels = w.getnchannels()
+            data = np.frombuffer(w.readframes(w.getnframes()), dtype='<i2')
+        return data.reshape(-1, channels).astype(np.float32) / 32768, sample_rate
+
+    def save(self, path, data, sample_rate, codec='wav'):
+        pcm = (np.clip(data, -1, 1) * 32767).astype('<i2')
+        with wave.open(path, 'wb') as w:
+            w.setnchannels(pcm.shape[1])
+            w.setsampwidth(2)
+            w.setframerate(sample_rate)
+            w.writeframes(pcm.tobytes())
+
+
+def load_model(model):
+    if model == 'stub':
+        return StubSeparator(), WavAdapter()
+
+    from spleeter.audio.adapter import AudioAdapter
+    from spleeter.separator import Separator
+
+    separator = Separator(model)
+    adapter = AudioAdapter.default()
+    # run once so the graph is built before the first real job
+    separator.separate(np.zeros((SAMPLE_RATE, 2), dtype=np.float32))
+    return separator, adapter
+
+
+def take_batch(red):
+    _, job = red.blpop(QUEUE)
+    jobs = [job]
+    while len(jobs) < BATCH_SIZE:
+        job = red.lpop(QUEUE)
+        if not job:
+            break
+        jobs.append(job)
+
+    return [json.loads(job) for job in jobs]
+
+
+def separate_batch(red, separator, adapter, jobs):
+    # one inference over the concatenated songs, then sliced back apart
+    loaded = []
+    for job in jobs:
+        try:
+            waveform, _ = adapter.load(job['input'], sample_rate=SAMPLE_RATE)
+            loaded.append((job, waveform))
+        except Exception as e:
+            reply(red, job, str(e))
+
+    if not loaded:
+        return
+
+    try:
+        stems = separator.separate(np.concatenate([waveform for _, waveform in loaded]))
+    except Exception as e:
+        # the whole batch went through the model together, so every song in it failed
+        for job, _ in loaded:
+            reply(red, job, str(e))
+        return
+
+    start = 0
+    for job, waveform in loaded:
+        end = start + len(waveform)
+        try:
+            write_stems(adapter, job, {name: stem[start:end] for name, stem in stems.items()})
+            reply(red, job)
+        except Exception as e:
+            reply(red, job, str(e))
+        start = end
+
+
+def write_stems(adapter, job, stems):
+    name = os.path.splitext(os.path.basename(job['input']))[0]
+    out_dir = os.path.join(job['output'], name)
+    os.makedirs(out_dir, exist_ok=True)
+    os.chown(out_dir, OWNER, OWNER)
+
+    for stem, data in stems.items():
+        path = os.path.join(out_dir, f'{stem}.wav')
+        adapter.save(path, data, SAMPLE_RATE, codec='wav')
+        os.chown(path, OWNER, OWNER)
+
+
+def reply(red, job, error=None):
+    red.rpush(job['reply'], json.dumps(dict(ok=not error, error=error)))
+    red.expire(job['reply'], 3600)
+    print(f"{job['input']}: {error or 'ok'}", flush=True)
+
+
+def serve(red, model, batches=None):
+    # batches bounds the loop, for tests; the service runs forever
+    separator, adapter = load_model(model)
+    print(f"loaded {model}, waiting on {QUEUE}", flush=True)
+
+    while batches is None or batches > 0:
+        separate_batch(red, separator, adapter, take_batch(red))
+        if batches is not None:
+            batches -= 1
+
+
+if __name__ == '__main__':
+    serve(StrictRedis(host=REDIS_HOST), sys.argv[1] if len(sys.argv) > 1 else MODEL)
@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the workers import each other both as server.x and, run as scripts, as x
+sys.path[:0] = [root, os.path.join(root, 'server')]
+
+# consts are read at import time, so the scratch db is set before any server module loads
+scratch = tempfile.mkdtemp(prefix='rekey-tests-')
+os.environ.setdefault('DATABASE_FILE', os.path.join(scratch, 'app.db'))
+
+
+@pytest.fixture
+def red():
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    import server.db
+
+    # status events go to redis pubsub, which nothing listens to here
+    monkeypatch.setattr(server.db, 'publish', lambda track_id, version: None)
+    return server.db
+
+
+@pytest.fixture
+def user(db):
+    from uuid import uuid4
+    return db.User.create(username=uuid4().hex)
+
+
+@pytest.fixture
+def workers(red, monkeypatch):
+    # tasks built in tests share the fake redis and never reach a docker daemon
+    from server import task
+    monkeypatch.setattr(task.docker, 'from_env', lambda: None)
+    monkeypatch.setattr(task, 'StrictRedis', lambda host=None, **kwargs: red)
+    return red
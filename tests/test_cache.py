@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from server import cache
+
+
+def make_track(db, user, status, url=None):
+    # 11 characters, like a youtube id
+    url = url or 'https://youtu.be/' + uuid4().hex[:11]
+    return db.Track.create(url=url, user=user, title='song', status=status)
+
+
+def test_first_run_owns_the_key(db, user, red):
+    track = make_track(db, user, db.TrackStatus.QUEUED)
+
+    assert not cache.follow(track, red)
+    key = cache.cache_key(track)
+    assert red.get(key) == str(track.id).encode()
+    assert 0 < red.ttl(key) <= cache.RESULT_CACHE_SECONDS
+
+
+def test_follower_is_settled_when_the_source_finishes_while_joining(db, user, red, monkeypatch):
+    source = make_track(db, user, db.TrackStatus.REKEYING)
+    assert not cache.follow(source, red)
+    db.TrackFile.create(track=source, key_offset=0, file_type=db.FileType.NORMAL_AUDIO, status=db.FileStatus.DONE,
+                        file_url='https://s3/x.mp3')
+    follower = make_track(db, user, db.TrackStatus.QUEUED, url=source.url)
+
+    rpush = red.rpush
+
+    def finish_first(key, *values):
+        # the source settles after the follower read it, but before it joined the list
+        source.set_status(db.TrackStatus.DONE)
+        cache.settle(source, red)
+        return rpush(key, *values)
+
+    monkeypatch.setattr(red, 'rpush', finish_first)
+    assert cache.follow(follower, red)
+
+    follower = db.Track.get_by_id(follower.id)
+    assert follower.is_status(db.TrackStatus.DONE)
+    assert [f.file_url for f in db.TrackFile.select().where(db.TrackFile.track == follower)] == ['https://s3/x.mp3']
+    assert red.llen(cache.followers_key(cache.cache_key(source))) == 0
+
+
+def test_stale_run_is_taken_over(db, user, red):
+    source = make_track(db, user, db.TrackStatus.DOWNLOADING)
+    assert not cache.follow(source, red)
+    stuck = datetime.now() - timedelta(seconds=cache.RESULT_CACHE_STALE_SECONDS + 60)
+    db.Track.update(updated=stuck).where(db.Track.id == source.id).execute()
+
+    waiting = make_track(db, user, db.TrackStatus.QUEUED, url=source.url)
+    red.rpush(cache.followers_key(cache.cache_key(source)), waiting.id)
+    track = make_track(db, user, db.TrackStatus.QUEUED, url=source.url)
+
+    assert not cache.follow(track, red)
+    assert red.get(cache.cache_key(track)) == str(track.id).encode()
+
+    # the new run settles whoever was waiting on the stale one
+    track.set_status(db.TrackStatus.DONE)
+    cache.settle(track, red)
+    assert db.Track.get_by_id(waiting.id).is_status(db.TrackStatus.DONE)
+
+
+def test_followers_settle_after_the_key_expired(db, user, red):
+    source = make_track(db, user, db.TrackStatus.REKEYING)
+    assert not cache.follow(source, red)
+    follower = make_track(db, user, db.TrackStatus.QUEUED, url=source.url)
+    assert cache.follow(follower, red)
+
+    red.delete(cache.cache_key(source))
+    source.set_status(db.TrackStatus.DONE)
+    cache.settle(source, red)
+
+    assert db.Track.get_by_id(follower.id).is_status(db.TrackStatus.DONE)
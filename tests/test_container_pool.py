@@ -0,0 +1,156 @@
+import itertools
+
+import pytest
+
+from server import task
+from server.errs import JobError
+from server.task import ContainerPool
+
+
+class FakeContainer:
+    def __init__(self, client, labels):
+        self.client = client
+        self.id = self.short_id = f'c{next(client.ids)}'
+        self.labels = labels or {}
+        self.status = 'running'
+        self.execs = []
+
+    def exec_run(self, cmd, user='', environment=None):
+        self.execs.append((cmd, user, environment))
+        return self.client.exit_codes.pop(0) if self.client.exit_codes else 0, b'out'
+
+    def reload(self):
+        pass
+
+    def remove(self, force=False):
+        self.status = 'removed'
+        self.client.removed.append(self.id)
+
+
+class FakeImages:
+    def get(self, image):
+        return type('Image', (), {'attrs': {'Config': {'Entrypoint': ['tool']}}})()
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+        self.started = []
+        self.leftover = []
+
+    def run(self, image, entrypoint=None, detach=False, volumes=None, labels=None, **kwargs):
+        assert detach and entrypoint == ['tail', '-f', '/dev/null']
+        container = FakeContainer(self.client, labels)
+        self.started.append(container)
+        return container
+
+    def list(self, all=False, filters=None):
+        return self.leftover
+
+
+class FakeDocker:
+    def __init__(self):
+        self.ids = itertools.count()
+        self.exit_codes = []
+        self.removed = []
+        self.images = FakeImages()
+        self.containers = FakeContainers(self)
+
+
+@pytest.fixture
+def client():
+    return FakeDocker()
+
+
+@pytest.fixture
+def exits(monkeypatch):
+    registered = []
+    monkeypatch.setattr(task.atexit, 'register', registered.append)
+    return registered
+
+
+def pool_for(client, size=2, max_jobs=10, **kwargs):
+    return ContainerPool(client, 'image', ['/host:/input'], size, max_jobs, channel='stage', **kwargs)
+
+
+def test_jobs_reuse_an_idle_container(client, exits):
+    pool = pool_for(client, user=1000)
+
+    pool.run('--in /input/a.wav', environment={'MODE': 'fast'})
+    pool.run('--in /input/b.wav')
+
+    assert len(client.containers.started) == 1
+    container = client.containers.started[0]
+    assert container.execs == [
+        (['tool', '--in', '/input/a.wav'], '1000', {'MODE': 'fast'}),
+        (['tool', '--in', '/input/b.wav'], '1000', None),
+    ]
+
+
+def test_container_is_recycled_after_max_jobs(client, exits):
+    pool = pool_for(client, max_jobs=2)
+
+    for _ in range(3):
+        pool.run('x')
+
+    first, second = client.containers.started
+    assert len(first.execs) == 2 and len(second.execs) == 1
+    assert client.removed == [first.id]
+    assert pool.started == 1
+
+
+def test_unhealthy_container_is_replaced(client, exits):
+    pool = pool_for(client)
+    pool.run('x')
+    dead = client.containers.started[0]
+    dead.status = 'exited'
+
+    pool.run('y')
+
+    assert client.removed == [dead.id]
+    assert len(client.containers.started[1].execs) == 1
+
+
+def test_failed_exec_raises_job_error_and_keeps_the_container(client, exits):
+    pool = pool_for(client)
+    client.exit_codes = [2]
+
+    with pytest.raises(JobError, match='exited 2'):
+        pool.run('x')
+
+    pool.run('y')
+    assert len(client.containers.started) == 1
+
+
+def test_reap_removes_containers_of_dead_workers(client, exits):
+    dead = FakeContainer(client, {'rekey.pool': 'stage', 'rekey.pool.worker': 'gone'})
+    living = FakeContainer(client, {'rekey.pool': 'stage', 'rekey.pool.worker': 'alive'})
+    client.containers.leftover = [dead, living]
+
+    pool_for(client, alive=lambda worker: worker == 'alive')
+
+    assert client.removed == [dead.id]
+
+
+def test_close_at_exit_removes_checked_out_containers_too(client, exits):
+    pool = pool_for(client)
+    pool.run('x')
+    busy = pool.checkout()
+    idle = pool.checkout()
+
+    assert exits == [pool.close]
+    exits[0]()
+
+    assert sorted(client.removed) == sorted([busy.id, idle.id])
+    assert not pool.containers
+
+
+def test_timings_keep_only_the_latest_samples(client, exits, monkeypatch):
+    monkeypatch.setattr(task, 'CONTAINER_POOL_TIMINGS', 3)
+    pool = pool_for(client)
+
+    for _ in range(5):
+        pool.run('x')
+
+    assert pool.timings
+    assert all(len(times) <= 3 for times in pool.timings.values())
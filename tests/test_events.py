@@ -0,0 +1,58 @@
+from uuid import uuid4
+
+import pytest
+
+
+@pytest.fixture
+def app(db, red, monkeypatch):
+    import server.app
+
+    monkeypatch.setattr(server.app, 'red', red)
+    # events are handed to the broker directly instead of through a subscription thread
+    broker = server.app.Broker(red)
+    broker.thread = True
+    monkeypatch.setattr(server.app, 'broker', broker)
+    return server.app
+
+
+def events(response):
+    chunks = iter(response.response)
+
+    def take():
+        chunk = next(chunks)
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        lines = chunk.strip().splitlines()
+        return lines[0].split(': ', 1)[1], '\n'.join(line[len('data: '):] for line in lines[1:])
+
+    return take
+
+
+def make_track(db, user):
+    return db.Track.create(url='https://youtu.be/' + uuid4().hex[:11], user=user, title=uuid4().hex,
+                           status=db.TrackStatus.QUEUED)
+
+
+def test_list_stream_starts_with_the_current_cards(app, db, user):
+    track = make_track(db, user)
+
+    take = events(app.app.test_client().get('/events/tracks'))
+
+    event, data = take()
+    assert event == 'trackCards'
+    assert track.title in data
+
+
+def test_new_song_reloads_the_list(app, db, user):
+    known = make_track(db, user)
+    take = events(app.app.test_client().get('/events/tracks'))
+    take()
+
+    added = make_track(db, user)
+    app.broker.notify(added.id)
+    assert take() == ('songsAdded', str(added.id))
+    assert take()[0] == 'trackCards'
+
+    # a song the stream already knows only gets its card swapped
+    app.broker.notify(known.id)
+    event, data = take()
+    assert event == 'trackCards' and known.title in data
@@ -0,0 +1,87 @@
+import time
+
+from server import jobs
+from server.jobs import JobQueue, FairJobQueue
+
+
+def test_worker_name_is_stable_within_a_process():
+    assert jobs.worker_name() == jobs.worker_name()
+
+
+def test_restarted_worker_gets_a_new_name(monkeypatch):
+    before = jobs.worker_name()
+    # same hostname and pid, as after a container restart
+    monkeypatch.setattr(jobs, '_boots', {})
+    assert jobs.worker_name() != before
+
+
+def test_restart_requeues_the_dead_workers_jobs(red, monkeypatch):
+    dead = JobQueue(red, 'q')
+    dead.push(['Track:1', 'Track:2'])
+    dead.renew()
+    assert dead.pop(timeout=1) == 'Track:1'
+    red.delete(dead.lease)
+
+    monkeypatch.setattr(jobs, '_boots', {})
+    restarted = JobQueue(red, 'q')
+    restarted.renew()
+
+    assert restarted.worker != dead.worker
+    assert restarted.reap() == 1
+    assert red.lrange('q', 0, -1) == [b'Track:1', b'Track:2']
+
+
+def test_fair_queue_goes_round_robin_over_users(red):
+    q = FairJobQueue(red, 'rekey')
+    q.push(['Track:1', 'Track:2', 'Track:3'], user=1, track=1)
+    q.push(['Track:4'], user=2, track=4)
+
+    assert [q.pop(timeout=1) for _ in range(4)] == ['Track:1', 'Track:4', 'Track:2', 'Track:3']
+    assert q.depth() == 0
+
+
+def test_fair_queue_serves_long_waiting_jobs_first(red, monkeypatch):
+    monkeypatch.setattr(jobs, 'FAIR_MAX_WAIT', 60)
+    q = FairJobQueue(red, 'rekey')
+    q.push(['Track:1', 'Track:2'], user=1, track=1)
+    q.push(['Track:3'], user=2, track=3)
+    # user 1's second job has been waiting for too long
+    red.zadd(q.age, {'Track:2': time.time() - 120})
+
+    assert q.pop(timeout=1) == 'Track:2'
+    assert q.pop(timeout=1) == 'Track:1'
+    assert q.pop(timeout=1) == 'Track:3'
+
+
+def test_fair_queue_requeue_keeps_the_priority(red):
+    q = FairJobQueue(red, 'rekey')
+    q.push(['Track:1', 'Track:2'], user=1, track=1, priorities=[0, 1])
+    assert q.pop(timeout=1) == 'Track:1'
+
+    assert q.requeue(q.inflight) == 1
+    assert red.llen('rekey') == 0
+    assert q.pop(timeout=1) == 'Track:1'
+    assert q.pop(timeout=1) == 'Track:2'
+
+
+def test_fair_queue_ack_keeps_a_copy_pushed_while_in_flight(red):
+    q = FairJobQueue(red, 'rekey')
+    q.push(['Track:1'], user=1, track=1)
+    assert q.pop(timeout=1) == 'Track:1'
+    q.push(['Track:1'], user=1, track=1)
+    q.ack('Track:1')
+
+    assert q.pop(timeout=1) == 'Track:1'
+    q.ack('Track:1')
+    assert not red.hexists(q.meta, 'Track:1')
+    assert q.depth() == 0
+
+
+def test_fair_queue_hands_out_jobs_whose_meta_is_gone(red):
+    q = FairJobQueue(red, 'rekey')
+    q.push(['Track:1', 'Track:2'], user=1, track=1)
+    red.hdel(q.meta, 'Track:1')
+
+    assert q.pop(timeout=1) == 'Track:1'
+    assert q.pop(timeout=1) == 'Track:2'
+    assert q.depth() == 0
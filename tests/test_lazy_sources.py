@@ -0,0 +1,102 @@
+import os
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pytest
+
+from server import cleanup
+from server.errs import JobError
+
+
+@pytest.fixture
+def volumes(db, tmp_path, monkeypatch):
+    ytdlp, spleets = tmp_path / 'ytdlp', tmp_path / 'spleets'
+    ytdlp.mkdir()
+    spleets.mkdir()
+    monkeypatch.setattr(db, 'YTDLP_OUTPUT_DIR', str(ytdlp))
+    monkeypatch.setattr(db, 'SPLEETER_OUTPUT_DIR', str(spleets))
+    monkeypatch.setattr(cleanup, 'SPLEETER_OUTPUT_DIR', str(spleets))
+    # only the tracks a test makes are swept
+    db.Track.update(flags=0).execute()
+    return tmp_path
+
+
+def lazy_track(db, user, used, status=None, size=1000):
+    track = db.Track.create(url='https://youtu.be/abcdefghijk', user=user, title='song', key='C', quality='major',
+                            flags=db.TrackFlags.REKEY_LAZY.value, status=status or db.TrackStatus.DONE)
+    db.Track.update(updated=used).where(db.Track.id == track.id).execute()
+    for source in track.source_files():
+        os.makedirs(os.path.dirname(source), exist_ok=True)
+        with open(source, 'wb') as f:
+            f.write(b'\0' * size)
+    return db.Track.get_by_id(track.id)
+
+
+def test_sources_past_the_age_limit_are_evicted(db, user, volumes):
+    now = datetime.now()
+    old = lazy_track(db, user, now - timedelta(days=cleanup.LAZY_SOURCE_DAYS + 1))
+    fresh = lazy_track(db, user, now)
+
+    cleanup.evict_sources(now)
+
+    assert not any(os.path.exists(path) for path in cleanup.source_paths(old))
+    assert fresh.has_sources()
+    assert old.lazy_offsets() == [] and fresh.lazy_offsets()
+
+
+def test_least_recently_used_go_over_budget(db, user, volumes, monkeypatch):
+    # two tracks' worth of sources
+    monkeypatch.setattr(cleanup, 'LAZY_SOURCE_BUDGET_MB', 4000 / 1024 / 1024)
+    now = datetime.now()
+    tracks = [lazy_track(db, user, now - timedelta(hours=hours)) for hours in (3, 1, 2)]
+
+    cleanup.evict_sources(now)
+
+    assert [track.has_sources() for track in tracks] == [False, True, True]
+
+
+def test_busy_track_keeps_its_sources(db, user, volumes, monkeypatch):
+    monkeypatch.setattr(cleanup, 'LAZY_SOURCE_BUDGET_MB', 0)
+    track = lazy_track(db, user, datetime.now(), status=db.TrackStatus.REKEYING)
+
+    cleanup.evict_sources()
+
+    assert track.has_sources()
+
+
+def test_render_refuses_once_the_sources_are_gone(db, user, volumes, red):
+    track = lazy_track(db, user, datetime.now() - timedelta(days=cleanup.LAZY_SOURCE_DAYS + 1))
+    cleanup.evict_sources()
+
+    with pytest.raises(JobError, match='removed'):
+        db.request_render(track, 3, red)
+    assert db.Track.get_by_id(track.id).status == db.TrackStatus.DONE
+    assert not db.TrackFile.select().where(db.TrackFile.track == track).exists()
+
+
+def test_render_endpoint_answers_gone(db, user, volumes, red, monkeypatch):
+    import server.app
+    monkeypatch.setattr(server.app, 'red', red)
+    track = lazy_track(db, user, datetime.now())
+    for path in track.source_files():
+        os.remove(path)
+
+    client = server.app.app.test_client()
+    client.post('/login', data=dict(username=user.username))
+    response = client.post(f'/track/{track.uuid}/render', data=dict(offset=3))
+
+    assert response.status_code == 410
+
+
+def test_render_endpoint_hides_other_users_private_tracks(db, user, volumes, red, monkeypatch):
+    import server.app
+    monkeypatch.setattr(server.app, 'red', red)
+    track = lazy_track(db, user, datetime.now())
+    db.Track.update(flags=track.flags | db.TrackFlags.PRIVATE.value).where(db.Track.id == track.id).execute()
+
+    client = server.app.app.test_client()
+    assert client.post(f'/track/{track.uuid}/render', data=dict(offset=3)).status_code == 302
+
+    client.post('/login', data=dict(username=uuid4().hex))
+    assert client.post(f'/track/{track.uuid}/render', data=dict(offset=3)).status_code == 404
+    assert not db.TrackFile.select().where(db.TrackFile.track == track).exists()
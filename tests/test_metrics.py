@@ -0,0 +1,50 @@
+import pytest
+
+from server import metrics
+
+
+@pytest.fixture
+def totals(db, monkeypatch):
+    totals = metrics.StatusTotals()
+    monkeypatch.setattr(metrics, 'totals', totals)
+    return totals
+
+
+def event(db, status, previous, elapsed):
+    return db.StatusEvent.create(kind='Bench', object_id=1, track_id=1, status=status, previous=previous,
+                                 elapsed=elapsed)
+
+
+def sample(lines, prefix):
+    return float(next(line for line in lines if line.startswith(prefix)).rsplit(' ', 1)[1])
+
+
+def test_scrapes_add_only_new_events(db, totals):
+    event(db, 'DOWNLOADING', 'NEEDS_DOWNLOAD', 0.3)
+    event(db, 'NEEDS_SPLIT', 'DOWNLOADING', 4)
+    totals.update()
+    seen = totals.last_id
+
+    event(db, 'DOWNLOADING', 'NEEDS_DOWNLOAD', 20)
+    event(db, 'ERROR', 'DOWNLOADING', 1)
+    totals.update()
+    assert totals.last_id == seen + 2
+
+    waiting = 'rekey_stage_duration_seconds_{}{{kind="Bench",status="NEEDS_DOWNLOAD"'
+    lines = metrics.stage_histograms()
+    assert sample(lines, waiting.format('count')) == 2
+    assert sample(lines, waiting.format('sum')) == pytest.approx(20.3)
+    assert sample(lines, waiting.format('bucket') + ',le="0.5"}') == 1
+    assert sample(lines, waiting.format('bucket') + ',le="30"}') == 2
+
+    lines = metrics.status_counters()
+    assert sample(lines, 'rekey_status_changes_total{kind="Bench",status="DOWNLOADING"}') == 2
+    assert sample(lines, 'rekey_status_changes_total{kind="Bench",status="ERROR"}') == 1
+
+
+def test_scrape_without_new_events_reads_nothing(db, totals, monkeypatch):
+    event(db, 'DONE', 'CLEANING_UP', 1)
+    totals.update()
+
+    monkeypatch.setattr(totals, 'add_stages', lambda new: pytest.fail('scanned again'))
+    totals.update()
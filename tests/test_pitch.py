@@ -0,0 +1,89 @@
+import subprocess
+
+import numpy as np
+import pytest
+
+from server import pitch, stream
+
+RATE = 44100
+
+
+def tone(seconds, hz=440):
+    t = np.arange(int(RATE * seconds)) / RATE
+    return (np.stack([np.sin(2 * np.pi * hz * t)] * 2, axis=1) * 16000).astype('<i2')
+
+
+def peak_hz(mono):
+    return np.argmax(np.abs(np.fft.rfft(mono))) * RATE / len(mono)
+
+
+def test_streamed_shift_keeps_the_length_and_moves_the_pitch():
+    samples = tone(3)
+    pieces = list(pitch.shift_blocks(samples, 5))
+
+    shifted = np.concatenate(pieces)
+    assert shifted.shape == samples.shape
+    assert max(len(piece) for piece in pieces) < len(samples) / 2
+    assert peak_hz(shifted[RATE:2 * RATE, 0]) == pytest.approx(440 * 2 ** (5 / 12), abs=1)
+
+
+def test_streamed_shift_matches_the_whole_song_shift():
+    samples = tone(2, hz=300)
+    whole = pitch.shift(samples, -3)
+    streamed = np.concatenate(list(pitch.shift_blocks(samples, -3)))
+
+    middle = slice(RATE // 2, -RATE // 2)
+    assert np.sqrt(np.mean((whole[middle] - streamed[middle]) ** 2)) < 0.01 * np.sqrt(np.mean(whole[middle] ** 2))
+
+
+def test_resampler_output_does_not_depend_on_the_pieces():
+    x = np.random.default_rng(0).standard_normal(20000).astype(np.float32)
+    at_once = pitch.Resampler(1.3, 15000).push(x, final=True)
+
+    resampler = pitch.Resampler(1.3, 15000)
+    pieces = [resampler.push(x[start:start + 777]) for start in range(0, len(x), 777)]
+    pieces.append(resampler.push(np.zeros(0, dtype=np.float32), final=True))
+
+    assert np.allclose(np.concatenate(pieces), at_once, atol=1e-6)
+    assert len(resampler.buffer) < 777 + 2 * pitch.TAPS
+
+
+class FakeS3:
+    def upload_fileobj(self, stream, bucket, name, Config=None):
+        self.body = stream.read()
+
+
+class Events(list):
+    put = list.append
+
+
+@pytest.fixture
+def encoder(monkeypatch):
+    # ffmpeg passes the pcm through untouched
+    popen = subprocess.Popen
+    monkeypatch.setattr(stream.subprocess, 'Popen', lambda command, **kwargs: popen(['cat'], **kwargs))
+    s3 = FakeS3()
+    monkeypatch.setattr(stream, '_s3', s3)
+    return s3
+
+
+def test_render_stream_feeds_every_block(encoder, monkeypatch):
+    samples = tone(1)
+    monkeypatch.setattr(pitch, '_source', (samples, RATE))
+
+    stream.render_stream(7, 2, 'bucket', 'name.mp3', 'title', Events())
+
+    streamed = np.frombuffer(encoder.body, dtype='<f4').reshape(-1, 2)
+    assert np.array_equal(streamed, np.concatenate(list(pitch.shift_blocks(samples, 2))))
+
+
+def test_render_stream_fails_when_the_shift_does(encoder, monkeypatch):
+    monkeypatch.setattr(pitch, '_source', (tone(1), RATE))
+
+    def broken(samples, semitones):
+        yield np.zeros((10, 2), dtype=np.float32)
+        raise MemoryError('shift failed')
+
+    monkeypatch.setattr(stream, 'shift_blocks', broken)
+    with pytest.raises(MemoryError):
+        stream.render_stream(7, 2, 'bucket', 'name.mp3', 'title', Events())
@@ -0,0 +1,103 @@
+import importlib.util
+import json
+import os
+import wave
+
+import numpy as np
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def service(monkeypatch):
+    path = os.path.join(os.path.dirname(here), 'spleeter', 'service.py')
+    spec = importlib.util.spec_from_file_location('spleeter_service', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    # the outputs are chowned to the docker user, which only root may do
+    monkeypatch.setattr(module, 'OWNER', os.getuid())
+    return module
+
+
+def write_wav(path, frames):
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(frames.astype('<i2').tobytes())
+
+
+def queue_job(service, red, tmp_path, name):
+    job = dict(input=str(tmp_path / f'{name}.wav'), output=str(tmp_path / 'out'), reply=f'done:{name}')
+    red.rpush(service.QUEUE, json.dumps(job))
+    return job
+
+
+def replies(red, names):
+    return {name: json.loads(red.lpop(f'done:{name}')) for name in names}
+
+
+def test_stub_batch_separates_each_song_and_replies(service, red, tmp_path):
+    songs = {'a': np.arange(200).reshape(-1, 2), 'b': -np.arange(100).reshape(-1, 2)}
+    for name, frames in songs.items():
+        write_wav(tmp_path / f'{name}.wav', frames)
+        queue_job(service, red, tmp_path, name)
+    queue_job(service, red, tmp_path, 'missing')
+
+    service.serve(red, 'stub', batches=1)
+
+    result = replies(red, ['a', 'b', 'missing'])
+    assert result['a'] == result['b'] == dict(ok=True, error=None)
+    assert not result['missing']['ok'] and result['missing']['error']
+
+    # the stub's accompaniment is the input, cut back to each song's own length
+    for name, frames in songs.items():
+        accompaniment, _ = service.WavAdapter().load(str(tmp_path / 'out' / name / 'accompaniment.wav'))
+        vocals, _ = service.WavAdapter().load(str(tmp_path / 'out' / name / 'vocals.wav'))
+        assert np.allclose(accompaniment * 32768, frames, atol=1)
+        assert not vocals.any()
+
+
+def test_batches_are_bounded(service, red, tmp_path, monkeypatch):
+    monkeypatch.setattr(service, 'BATCH_SIZE', 2)
+    sizes = []
+    stub = service.StubSeparator.separate
+    monkeypatch.setattr(service.StubSeparator, 'separate', lambda self, waveform: sizes.append(len(waveform)) or
+                        stub(self, waveform))
+
+    names = [f's{n}' for n in range(5)]
+    for name in names:
+        write_wav(tmp_path / f'{name}.wav', np.ones((10, 2)))
+        queue_job(service, red, tmp_path, name)
+
+    service.serve(red, 'stub', batches=3)
+
+    assert sizes == [20, 20, 10]
+    assert all(reply['ok'] for reply in replies(red, names).values())
+    assert red.llen(service.QUEUE) == 0
+
+
+def test_failed_separation_fails_the_batch_and_keeps_serving(service, red, tmp_path, monkeypatch):
+    monkeypatch.setattr(service, 'BATCH_SIZE', 2)
+    calls = []
+    stub = service.StubSeparator.separate
+
+    def separate(self, waveform):
+        calls.append(len(waveform))
+        if len(calls) == 1:
+            raise RuntimeError('out of memory')
+        return stub(self, waveform)
+
+    monkeypatch.setattr(service.StubSeparator, 'separate', separate)
+
+    names = ['a', 'b', 'c']
+    for name in names:
+        write_wav(tmp_path / f'{name}.wav', np.ones((10, 2)))
+        queue_job(service, red, tmp_path, name)
+
+    service.serve(red, 'stub', batches=2)
+
+    result = replies(red, names)
+    assert result['a'] == result['b'] == dict(ok=False, error='out of memory')
+    assert result['c'] == dict(ok=True, error=None)
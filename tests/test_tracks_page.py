@@ -0,0 +1,58 @@
+import re
+from uuid import uuid4
+
+import pytest
+from peewee import SqliteDatabase
+
+from server.migrations import drop_track_updated_index
+
+
+@pytest.fixture
+def client(db, red, monkeypatch):
+    import server.app
+
+    monkeypatch.setattr(server.app, 'red', red)
+    monkeypatch.setitem(server.app.app.config, 'PAGE_SIZE', 3)
+    client = server.app.app.test_client()
+    client.post('/login', data=dict(username=uuid4().hex))
+    return client
+
+
+def page(client, before=None):
+    html = client.get('/tracks' + (f'?before={before}' if before else '')).data.decode()
+    cursor = re.search(r'before=(\d+)', html)
+    return [int(id) for id in re.findall(r'id="track-(\d+)"', html)], cursor and cursor.group(1)
+
+
+def test_paging_is_stable_while_tracks_change(db, user, client):
+    mine = [db.Track.create(url=f'u{n}', user=user, title='song', status=db.TrackStatus.QUEUED) for n in range(7)]
+
+    seen, cursor = page(client)
+    # a track on a later page moves on while the first page is on screen
+    mine[0].set_status(db.TrackStatus.NEEDS_METADATA)
+    while cursor:
+        ids, cursor = page(client, cursor)
+        seen += ids
+
+    assert len(seen) == len(set(seen))
+    assert seen == sorted(seen, reverse=True)
+    assert {track.id for track in mine} <= set(seen)
+
+
+def test_migration_drops_the_updated_index(tmp_path):
+    database = SqliteDatabase(str(tmp_path / 'old.db'))
+    database.execute_sql('CREATE TABLE track (id INTEGER PRIMARY KEY, updated DATETIME)')
+    database.execute_sql('CREATE INDEX track_updated_id ON track (updated, id)')
+
+    drop_track_updated_index(database, None)
+
+    assert not database.execute_sql("SELECT 1 FROM sqlite_master WHERE name = 'track_updated_id'").fetchone()
+
+
+def test_track_clock_counts_from_the_creation_instant(db, user, client):
+    track = db.Track.create(url='u', user=user, title='song', key='C', quality='major', status=db.TrackStatus.QUEUED)
+
+    html = client.get(f'/track/{track.uuid}').data.decode()
+
+    created = int(re.search(r'data-created="(\d+)"', html).group(1))
+    assert created == int(track.created.timestamp() * 1000)
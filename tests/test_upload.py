@@ -0,0 +1,91 @@
+import pytest
+
+from server import consts, db as database, s3, upload
+from server.upload import UploadTask
+
+
+class FakeS3:
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.uploads = []
+
+    def upload_file(self, path, bucket, name, Config=None):
+        if name in self.fail:
+            raise OSError(f'connection reset uploading {name}')
+        self.uploads.append((path, bucket, name, Config))
+
+
+@pytest.fixture
+def batched(monkeypatch):
+    monkeypatch.setattr(upload, 'UPLOAD_BATCH', True)
+    monkeypatch.setattr(database, 'UPLOAD_BATCH', True)
+
+
+@pytest.fixture
+def track(db, user):
+    return db.Track.create(url='https://youtu.be/abcdefghijk', user=user, title='song', key='C', quality='major',
+                           status=db.TrackStatus.REKEYING)
+
+
+def ready_files(db, track, red, tmp_path, offsets):
+    files = []
+    for offset in offsets:
+        track_file = db.TrackFile.create(track=track, key_offset=offset, file_type=db.FileType.NORMAL_AUDIO,
+                                         status=db.FileStatus.ENCODING)
+        audio = tmp_path / f'{offset}.mp3'
+        audio.write_bytes(b'mp3')
+        db.queue_upload(track_file, str(audio), red)
+        files.append((track_file, str(audio)))
+    return files
+
+
+def test_only_one_claim_wins(db, track):
+    track_file = db.TrackFile.create(track=track, key_offset=0, file_type=db.FileType.NORMAL_AUDIO,
+                                     status=db.FileStatus.NEEDS_UPLOAD)
+    other = db.TrackFile.get_by_id(track_file.id)
+
+    assert db.claim(track_file, [db.FileStatus.NEEDS_UPLOAD], db.FileStatus.UPLOADING)
+    assert not db.claim(other, [db.FileStatus.NEEDS_UPLOAD], db.FileStatus.UPLOADING)
+    assert db.TrackFile.get_by_id(track_file.id).status == db.FileStatus.UPLOADING
+
+
+def test_claim_pending_skips_files_claimed_elsewhere(db, track, red, tmp_path, batched):
+    (first, _), (taken, _), (third, _) = ready_files(db, track, red, tmp_path, [0, 1, 2])
+    db.claim(db.TrackFile.get_by_id(taken.id), [db.FileStatus.NEEDS_UPLOAD], db.FileStatus.UPLOADING)
+
+    claimed = db.claim_pending(db.Queue.UPLOAD, track, [db.FileStatus.NEEDS_UPLOAD], db.FileStatus.UPLOADING, red)
+
+    assert sorted(f.id for f, _ in claimed) == [first.id, third.id]
+    assert not red.exists(db.pending_key(db.Queue.UPLOAD, track.id))
+
+
+def test_batch_isolates_a_failed_upload(db, track, red, tmp_path, batched, workers):
+    files = ready_files(db, track, red, tmp_path, [0, 1, 2])
+    broken = files[1][0].nice_name()
+    task = UploadTask(s3=FakeS3(fail={broken}))
+
+    first, audio = files[0]
+    task.work(first, [audio])
+
+    assert sorted(name for _, _, name, _ in task.s3.uploads) == sorted(f.nice_name() for f, _ in files
+                                                                       if f.nice_name() != broken)
+    assert all(config is s3.transfer_config for _, _, _, config in task.s3.uploads)
+
+    statuses = {f.id: db.TrackFile.get_by_id(f.id) for f, _ in files}
+    assert statuses[files[1][0].id].status == db.FileStatus.ERROR
+    assert 'connection reset' in statuses[files[1][0].id].error_message
+    for track_file, _ in [files[0], files[2]]:
+        assert statuses[track_file.id].status == db.FileStatus.DONE
+        assert statuses[track_file.id].file_url
+
+    # the other files' own jobs find nothing left to claim
+    second, audio = files[2]
+    task.work(db.TrackFile.get_by_id(second.id), [audio])
+    assert len(task.s3.uploads) == 2
+
+
+def test_transfers_are_multipart_above_one_chunk():
+    config = s3.transfer_config
+    assert config.multipart_threshold == consts.S3_MULTIPART_CHUNK_SIZE
+    assert config.multipart_chunksize == consts.S3_MULTIPART_CHUNK_SIZE
+    assert config.max_concurrency == consts.S3_MAX_CONCURRENCY
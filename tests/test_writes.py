@@ -0,0 +1,53 @@
+import threading
+
+import pytest
+from peewee import SqliteDatabase, OperationalError
+
+from server.writes import GroupCommit
+
+
+class FailingConnect(SqliteDatabase):
+    def connect(self, reuse_if_open=False):
+        raise OperationalError('unable to open database file')
+
+
+def test_batch_commits_every_write(tmp_path):
+    database = SqliteDatabase(str(tmp_path / 'w.db'))
+    database.execute_sql('CREATE TABLE t (n INTEGER)')
+    database.close()
+    group = GroupCommit(database)
+
+    values = [group.run(lambda n=n: database.execute_sql('INSERT INTO t VALUES (?)', (n,)) and n) for n in range(3)]
+
+    assert values == [0, 1, 2]
+    assert database.execute_sql('SELECT COUNT(*) FROM t').fetchone()[0] == 3
+
+
+def test_failed_connect_reaches_every_writer_and_frees_the_lead(tmp_path):
+    group = GroupCommit(FailingConnect(str(tmp_path / 'w.db')))
+    errors = []
+
+    def write():
+        try:
+            group.run(lambda: 1)
+        except OperationalError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(errors) == 4
+    assert not group.leading and not group.pending
+
+
+def test_leader_hands_over_when_commit_blows_up(tmp_path):
+    group = GroupCommit(SqliteDatabase(str(tmp_path / 'w.db')))
+    group.commit = lambda batch: (_ for _ in ()).throw(RuntimeError('boom'))
+
+    with pytest.raises(RuntimeError):
+        group.commit_pending()
+    assert not group.leading